@@ -18,9 +18,19 @@
 
 import os
 import argparse
+import contextlib
+import io
+import mmap
+import re
+import shutil
 import struct
+import tempfile
 import zlib
 import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipFile, ZipFile
+
+from apkzip import ZipRewriteError, rewrite_zip
 
 # ref: https://source.android.com/docs/core/runtime/dex-format#embedded-in-header_item
 DEX_MAGIC_035 = b"dex\n035\0"
@@ -28,6 +38,10 @@ DEX_MAGIC_037 = b"dex\n037\0"
 DEX_MAGIC_038 = b"dex\n038\0"
 DEX_MAGIC_039 = b"dex\n039\0"
 DEX_MAGIC_VERSIONS = [DEX_MAGIC_035, DEX_MAGIC_037, DEX_MAGIC_038, DEX_MAGIC_039]
+DEX_HEADER_HASHED_SIZE = 32  # magic + checksum + signature
+HASH_CHUNK_SIZE = 1024 * 1024
+DEX_CONTAINER_EXTENSIONS = (".apk", ".zip", ".jar")
+APK_DEX_ENTRY_PATTERN = re.compile(r"classes\d*\.dex")
 
 
 class DexRepairError(Exception):
@@ -52,15 +66,15 @@ def is_valid_dex_magic(dex_file):
     return magic in DEX_MAGIC_VERSIONS
 
 
-def repair_dex_magic(dex_data: bytearray):
+def repair_dex_magic(dex_data):
     """
     This function checks if the DEX magic number in the given bytearray is valid. If it is not valid, it replaces the magic number with a valid one (DEX_MAGIC_035).
 
     Parameters:
-    dex_data (bytearray): The bytearray containing the dex data.
+    dex_data (bytearray | mmap.mmap): The writable buffer containing the dex data.
 
     Returns:
-    bytearray: The bytearray containing the updated dex data.
+    bytearray | mmap.mmap: The same buffer, with the updated magic.
 
     Note:
     The DEX magic number is the first 8 bytes of the dex data. The valid magic number for this function is DEX_MAGIC_035.
@@ -72,70 +86,248 @@ def repair_dex_magic(dex_data: bytearray):
     return dex_data
 
 
-def update_dex_hashes(dex_data: bytearray, repair_sha1: bool = False):
+def update_dex_hashes(dex_data, repair_sha1: bool = False):
     """
-    This function updates the checksum and signature in the DEX header of a given bytearray containing dex data.
+    This function updates the checksum and signature in the DEX header of the given dex data.
 
     Parameters:
-    dex_data (bytearray): The bytearray containing the dex data.
+    dex_data (bytearray | mmap.mmap): The writable buffer containing the dex data.
     repair_sha1 (bool): If True, the SHA-1 signature is updated. If False, the SHA-1 signature is not updated.
 
     Returns:
-    bytearray: The bytearray containing the updated dex data.
+    bytearray | mmap.mmap: The same buffer, with the updated header.
 
     Note:
     The checksum is calculated using the zlib.adler32 function, starting from the 13th byte of the dex data.
     The signature is calculated using the hashlib.sha1 function, starting from the 33rd byte of the dex data.
+    Both are computed incrementally over memoryview chunks of HASH_CHUNK_SIZE bytes, so the dex data is never copied.
     The updated checksum is then packed into a 4-byte little-endian integer and written back into the dex data, starting from the 9th byte.
     The updated signature is then written back into the dex data, starting from the 13th byte.
     """
-    if repair_sha1:
-        signature = hashlib.sha1(dex_data[32:]).digest()
-        print(f"Signature: {signature.hex()}")
-        dex_data[12:32] = signature
-
-    checksum = zlib.adler32(dex_data[12:])
-    print(f"Checksum: {checksum:#x}")
-    dex_data[8:12] = struct.pack("<I", checksum)
+    with memoryview(dex_data) as view:
+        if repair_sha1:
+            sha1 = hashlib.sha1()
+            for offset in range(DEX_HEADER_HASHED_SIZE, len(view), HASH_CHUNK_SIZE):
+                sha1.update(view[offset : offset + HASH_CHUNK_SIZE])
+            signature = sha1.digest()
+            print(f"Signature: {signature.hex()}")
+            view[12:32] = signature
+
+        checksum = 1
+        for offset in range(12, len(view), HASH_CHUNK_SIZE):
+            checksum = zlib.adler32(view[offset : offset + HASH_CHUNK_SIZE], checksum)
+        print(f"Checksum: {checksum:#x}")
+        view[8:12] = struct.pack("<I", checksum)
 
     return dex_data
 
 
+def find_dex_files(dex_path: str, recursive: bool = False):
+    """
+    This function lists the dex files to repair in the given directory.
+
+    Parameters:
+    dex_path (str): The directory to search.
+    recursive (bool, optional): If True, the whole directory tree is searched and the dex entries of APK, ZIP and JAR containers are included. Default is False.
+
+    Returns:
+    list: (file path, entry name) tuples, sorted by path. The entry name is the dex entry inside a container, or None for plain dex files.
+    """
+    if recursive:
+        file_paths = [
+            os.path.join(dirpath, filename)
+            for dirpath, _, filenames in os.walk(dex_path)
+            for filename in filenames
+        ]
+    else:
+        file_paths = [
+            os.path.join(dex_path, filename) for filename in os.listdir(dex_path)
+        ]
+
+    dex_files = []
+    for file_path in sorted(file_paths):
+        if file_path.endswith(".dex"):
+            dex_files.append((file_path, None))
+        elif recursive and file_path.endswith(DEX_CONTAINER_EXTENSIONS):
+            try:
+                with ZipFile(file_path) as container:
+                    dex_files.extend(
+                        (file_path, entry)
+                        for entry in container.namelist()
+                        if entry.endswith(".dex")
+                    )
+            except BadZipFile:
+                print(f"Skipping invalid container: {file_path}")
+    return dex_files
+
+
+def container_output_dir(container_path: str) -> str:
+    """Directory the repaired dex entries of an APK/ZIP/JAR container are written to."""
+    return os.path.splitext(container_path)[0] + "_dex"
+
+
+def entry_output_path(output_dir: str, entry: str) -> str:
+    """
+    This function returns where a container entry is written under output_dir.
+
+    Raises:
+    DexRepairError: If the entry name is absolute or has `..` components, so it would be written outside output_dir.
+    """
+    parts = entry.replace("\\", "/").split("/")
+    if entry.startswith(("/", "\\")) or os.path.splitdrive(entry)[0] or ".." in parts:
+        raise DexRepairError(f"Unsafe entry name: {entry}")
+    return os.path.join(output_dir, *[part for part in parts if part not in ("", ".")])
+
+
+def repair_dex_entry(
+    container_path: str,
+    entry: str,
+    repair_sha1: bool = False,
+    output_dex_path: str = None,
+):
+    """
+    This function repairs a dex entry of an APK, ZIP or JAR container. The entry is streamed out of the container to the output path and repaired there.
+
+    Parameters:
+    container_path (str): The path to the container.
+    entry (str): The name of the dex entry inside the container.
+    repair_sha1 (bool, optional): If True, the SHA-1 signature is updated. Default is False.
+    output_dex_path (str, optional): The output path for the repaired dex file. If not provided, it is written under the container's `_dex` directory.
+
+    Returns:
+    dict: The repair result, see repair_dex_file().
+    """
+    if not output_dex_path:
+        output_dex_path = entry_output_path(container_output_dir(container_path), entry)
+    os.makedirs(os.path.dirname(output_dex_path) or ".", exist_ok=True)
+    with ZipFile(container_path) as container:
+        with container.open(entry) as src, open(output_dex_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, HASH_CHUNK_SIZE)
+    result = repair_dex_file(output_dex_path, repair_sha1)
+    result["path"] = f"{container_path}!{entry}"
+    return result
+
+
+def _repair_dex_task(task):
+    file_path, entry, repair_sha1, output_file_path = task
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if entry is None:
+                return repair_dex_file(file_path, repair_sha1, output_file_path)
+            return repair_dex_entry(file_path, entry, repair_sha1, output_file_path)
+    except (DexRepairError, OSError, BadZipFile) as e:
+        return {
+            "path": f"{file_path}!{entry}" if entry else file_path,
+            "error": str(e),
+        }
+
+
+def print_repair_summary(results):
+    """
+    This function prints one line per repaired dex file: the fixed magic, and the old and new checksum and signature.
+
+    Parameters:
+    results (list): Results returned by repair_dex().
+    """
+    for result in results:
+        if "error" in result:
+            print(f"{result['path']}: FAILED ({result['error']})")
+            continue
+        magic = "ok"
+        if result["old_magic"] != result["new_magic"]:
+            magic = f"{result['old_magic']!r} -> {result['new_magic']!r}"
+        print(
+            f"{result['path']}: magic {magic}, "
+            f"checksum {result['old_checksum']:#010x} -> {result['new_checksum']:#010x}, "
+            f"signature {result['old_signature']} -> {result['new_signature']}"
+        )
+    failed = sum("error" in result for result in results)
+    print(f"Repaired {len(results) - failed} dex file(s), {failed} failed.")
+
+
 def repair_dex(
     dex_path: str,
     repair_sha1: bool = False,
     output_dex_path: str = None,
+    recursive: bool = False,
+    jobs: int = 1,
 ):
     """
     This function repairs dex files in the given path. If the path is a directory, it will repair all dex files within that directory. If the path is a file, it will repair that specific dex file.
 
     Parameters:
-    dex_path (str): The path to the dex file or directory containing dex files.
+    dex_path (str): The path to the dex file, APK/ZIP/JAR container or directory containing dex files.
     repair_sha1 (bool, optional): If True, the SHA-1 signature is updated. If False, the SHA-1 signature is not updated. Default is False.
     output_dex_path (str, optional): The output path for the repaired dex files. If not provided, the repaired dex files will be overwritten in the original location.
+    recursive (bool, optional): If True, the directory tree is searched recursively, including dex entries of APK/ZIP/JAR containers. Default is False.
+    jobs (int, optional): Number of worker processes used to repair a directory. Default is 1.
 
     Returns:
-    None
+    list: One result dict per dex file (see repair_dex_file()), or {"path", "error"} for files that failed.
 
     Raises:
     DexRepairError: If the provided dex_path is not a valid directory or file.
+
+    Note:
+    Inside a directory, the dex entries of a container are written to `<container>_dex/` under the output directory, mirroring the directory layout.
+    A container given directly as dex_path has its dex entries written to the output directory, or `<container>_dex/` next to it.
     """
+    rejected = []
     if os.path.isdir(dex_path):
-        for filename in os.listdir(dex_path):
-            if filename.endswith(".dex"):
-                file_path = os.path.join(dex_path, filename)
-                output_file_path = (
-                    os.path.join(output_dex_path, filename) if output_dex_path else None
-                )
-                if not os.path.isdir(output_dex_path):
-                    raise DexRepairError(f"{output_dex_path} not a directory!")
-                print(f"Repairing {file_path}...")
-                repair_dex_file(file_path, repair_sha1, output_file_path)
+        if output_dex_path and not os.path.isdir(output_dex_path):
+            raise DexRepairError(f"{output_dex_path} not a directory!")
+        output_root = output_dex_path or dex_path
+        tasks = []
+        for file_path, entry in find_dex_files(dex_path, recursive):
+            relative_path = os.path.relpath(file_path, dex_path)
+            if entry is None:
+                output_file_path = os.path.join(output_root, relative_path)
+            else:
+                try:
+                    output_file_path = entry_output_path(
+                        container_output_dir(os.path.join(output_root, relative_path)),
+                        entry,
+                    )
+                except DexRepairError as e:
+                    rejected.append({"path": f"{file_path}!{entry}", "error": str(e)})
+                    continue
+            os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+            tasks.append((file_path, entry, repair_sha1, output_file_path))
+    elif os.path.isfile(dex_path) and dex_path.endswith(DEX_CONTAINER_EXTENSIONS):
+        output_root = output_dex_path or container_output_dir(dex_path)
+        tasks = []
+        with ZipFile(dex_path) as container:
+            for entry in container.namelist():
+                if not entry.endswith(".dex"):
+                    continue
+                try:
+                    output_file_path = entry_output_path(output_root, entry)
+                except DexRepairError as e:
+                    rejected.append({"path": f"{dex_path}!{entry}", "error": str(e)})
+                    continue
+                tasks.append((dex_path, entry, repair_sha1, output_file_path))
     elif os.path.isfile(dex_path):
-        repair_dex_file(dex_path, repair_sha1, output_dex_path)
+        return [repair_dex_file(dex_path, repair_sha1, output_dex_path)]
     else:
         raise DexRepairError(f"Path not found: {dex_path}")
 
+    print(f"Repairing {len(tasks)} dex file(s) with {jobs} job(s)...")
+    results = None
+    if jobs > 1 and len(tasks) > 1:
+        try:
+            executor = ProcessPoolExecutor(max_workers=jobs)
+        except (ImportError, NotImplementedError, OSError) as e:
+            print(f"Workers unavailable ({e}), repairing in this process.")
+        else:
+            with executor:
+                results = list(executor.map(_repair_dex_task, tasks))
+    if results is None:
+        results = [_repair_dex_task(task) for task in tasks]
+    results = rejected + results
+
+    print_repair_summary(results)
+    return results
+
 
 def repair_dex_file(
     dex_file_path: str, repair_sha1: bool = False, output_dex_path: str = None
@@ -149,46 +341,207 @@ def repair_dex_file(
     output_dex_path (str, optional): The output path for the repaired dex file. If not provided, the repaired dex file will be overwritten in the original location.
 
     Returns:
-    None
+    dict: The repair result: path, output, old/new magic, old/new checksum and old/new signature (hex).
 
     Raises:
     DexRepairError: If the provided dex_file_path is not a valid file.
+
+    Note:
+    The file is first streamed to the output path (if any) and then memory-mapped and repaired in place,
+    so large dex files are never loaded into memory. If the file cannot be memory-mapped it is repaired in memory instead.
     """
-    try:
-        with open(dex_file_path, "rb") as f:
-            dex_data = bytearray(f.read())
-    except FileNotFoundError:
+    if not os.path.isfile(dex_file_path):
         raise DexRepairError(f"DEX file not found: {dex_file_path}")
+    if os.path.getsize(dex_file_path) < DEX_HEADER_HASHED_SIZE:
+        raise DexRepairError(f"File too small to be a DEX file: {dex_file_path}")
+
+    if output_dex_path and not (
+        os.path.exists(output_dex_path)
+        and os.path.samefile(dex_file_path, output_dex_path)
+    ):
+        shutil.copyfile(dex_file_path, output_dex_path)
+    else:
+        output_dex_path = dex_file_path
 
-    dex_data = repair_dex_magic(dex_data)
-    dex_data = update_dex_hashes(dex_data, repair_sha1)
+    result = {"path": dex_file_path, "output": output_dex_path}
+    with open(output_dex_path, "r+b") as f:
+        _repair_open_dex_file(f, repair_sha1, result)
+    return result
 
-    if output_dex_path:
-        with open(output_dex_path, "wb") as f:
-            f.write(dex_data)
-    else:
-        with open(dex_file_path, "wb") as f:
-            f.write(dex_data)
+
+def _repair_open_dex_file(f, repair_sha1, result):
+    try:
+        dex_data = mmap.mmap(f.fileno(), 0)
+    except (OSError, ValueError):
+        f.seek(0)
+        dex_data = bytearray(f.read())
+        _repair_dex_data(dex_data, repair_sha1, result)
+        f.seek(0)
+        f.write(dex_data[:DEX_HEADER_HASHED_SIZE])
+        return
+
+    with dex_data:
+        _repair_dex_data(dex_data, repair_sha1, result)
+        dex_data.flush()
+
+
+def read_dex_header(dex_data):
+    """
+    This function reads the hashed part of the DEX header.
+
+    Parameters:
+    dex_data (bytearray | mmap.mmap): The buffer containing the dex data.
+
+    Returns:
+    tuple: The magic (bytes), checksum (int) and signature (hex str).
+    """
+    magic = bytes(dex_data[:8])
+    (checksum,) = struct.unpack_from("<I", dex_data, 8)
+    return magic, checksum, bytes(dex_data[12:32]).hex()
+
+
+def _repair_dex_data(dex_data, repair_sha1, result):
+    result["old_magic"], result["old_checksum"], result["old_signature"] = (
+        read_dex_header(dex_data)
+    )
+    repair_dex_magic(dex_data)
+    update_dex_hashes(dex_data, repair_sha1)
+    result["new_magic"], result["new_checksum"], result["new_signature"] = (
+        read_dex_header(dex_data)
+    )
+
+
+def _write_repaired_entry(src_zip, info, dst, repair_sha1, result):
+    """
+    Stream a dex entry through the hash fix-up and write its (re)compressed data to dst.
+
+    Returns:
+    tuple: The method, CRC-32, compressed size and uncompressed size of the written data.
+    """
+    with tempfile.TemporaryFile() as temp:
+        with src_zip.open(info) as src:
+            shutil.copyfileobj(src, temp, HASH_CHUNK_SIZE)
+        temp.flush()
+        if temp.tell() < DEX_HEADER_HASHED_SIZE:
+            raise DexRepairError(f"Entry too small to be a DEX file: {info.filename}")
+        _repair_open_dex_file(temp, repair_sha1, result)
+
+        temp.seek(0)
+        method = ZIP_STORED if info.compress_type == ZIP_STORED else ZIP_DEFLATED
+        compressor = (
+            zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            if method == ZIP_DEFLATED
+            else None
+        )
+        crc = compress_size = file_size = 0
+        while chunk := temp.read(HASH_CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            dst.write(chunk)
+            compress_size += len(chunk)
+        if compressor:
+            chunk = compressor.flush()
+            dst.write(chunk)
+            compress_size += len(chunk)
+    return method, crc, compress_size, file_size
+
+
+def repair_apk(apk_path: str, repair_sha1: bool = False, output_apk_path: str = None):
+    """
+    This function repairs the classes*.dex entries of an APK and writes them into a new APK, without extracting and re-zipping it.
+
+    Parameters:
+    apk_path (str): The path to the APK (or ZIP/JAR) file.
+    repair_sha1 (bool, optional): If True, the SHA-1 signature is updated. Default is False.
+    output_apk_path (str, optional): The output path for the repaired APK. If not provided, `<name>_repaired.apk` is used.
+
+    Returns:
+    list: One result dict per repaired dex entry, see repair_dex_file().
+
+    Raises:
+    DexRepairError: If the APK is not a valid ZIP file, needs ZIP64 or the output would overwrite it.
+
+    Note:
+    All other entries are copied raw (still compressed) in their original order, see apkzip.rewrite_zip(). Stored
+    entries keep their zipalign alignment. The output is not signed: the APK Signing Block is dropped, so re-sign it
+    before installing.
+    """
+    if not os.path.isfile(apk_path):
+        raise DexRepairError(f"APK file not found: {apk_path}")
+    if not output_apk_path:
+        output_apk_path = os.path.splitext(apk_path)[0] + "_repaired.apk"
+
+    results = []
+
+    def write_entry(src_zip, info, dst):
+        if not APK_DEX_ENTRY_PATTERN.fullmatch(info.filename):
+            return None
+        result = {"path": f"{apk_path}!{info.filename}", "output": output_apk_path}
+        written = _write_repaired_entry(src_zip, info, dst, repair_sha1, result)
+        results.append(result)
+        return written
+
+    try:
+        rewrite_zip(apk_path, output_apk_path, write_entry)
+    except ZipRewriteError as e:
+        raise DexRepairError(str(e)) from e
+
+    print_repair_summary(results)
+    print(f"Repaired APK written to {output_apk_path} (re-sign it before installing)")
+    return results
 
 
 def main():
     epilog = "A command-line tool for repairing DEX files. It fixes the DEX magic number and updates the checksum and signature in the DEX header."
     parser = argparse.ArgumentParser(description="DEX Repair Tool", epilog=epilog)
-    parser.add_argument("dex_file", help="Path to the DEX file")
+    parser.add_argument(
+        "dex_file", help="Path to the DEX file, APK/ZIP/JAR or a directory"
+    )
     parser.add_argument("-o", "--output", help="Path to the output DEX file (optional)")
     parser.add_argument(
         "-s", "--sha", action="store_true", help="Repair SHA1 hash (optional)"
     )
+    parser.add_argument(
+        "-a",
+        "--apk",
+        action="store_true",
+        help="Repair classes*.dex inside an APK and write a new APK (optional)",
+    )
+    parser.add_argument(
+        "-r",
+        "--recursive",
+        action="store_true",
+        help="Search directories recursively, including APK/ZIP/JAR files (optional)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes for directories (optional)",
+    )
 
     args = parser.parse_args()
 
+    if args.apk:
+        try:
+            repair_apk(args.dex_file, args.sha, args.output)
+            print("DEX repair completed successfully.")
+        except DexRepairError as e:
+            print(f"Error: {e}")
+        return
+
     if args.output:
         output = args.output
-    else:
+    elif os.path.isfile(args.dex_file) and args.dex_file.endswith(".dex"):
         output = args.dex_file.replace(".dex", "_repaired.dex")
+    else:
+        output = None
 
     try:
-        repair_dex(args.dex_file, args.sha, output)
+        repair_dex(args.dex_file, args.sha, output, args.recursive, max(1, args.jobs))
         print("DEX repair completed successfully.")
 
     except DexRepairError as e:
@@ -0,0 +1,199 @@
+#  This file is part of RevEngi - @RevEngiBot (Telegram Bot)
+#  Copyright (C) 2023-present RevEngiSquad - Organization
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Raw APK rewriting shared by DexRepair.py and cocos2d.py."""
+
+import contextlib
+import os
+import struct
+from zipfile import ZIP_STORED, BadZipFile, ZipFile
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# ref: https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT (4.3.7, 4.3.12, 4.3.16)
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+ZIP_LOCAL_HEADER_SIGNATURE = 0x04034B50
+ZIP_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP_CENTRAL_HEADER_SIGNATURE = 0x02014B50
+ZIP_END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP_END_RECORD_SIGNATURE = 0x06054B50
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+ZIP_MAX_OFFSET = 0xFFFFFFFF
+
+
+class ZipRewriteError(Exception):
+    pass
+
+
+def strip_zip_padding(extra: bytes) -> bytes:
+    """Drop zipalign padding (zero bytes or truncated records) from a local extra field."""
+    end = 0
+    while end + 4 <= len(extra):
+        header_id, size = struct.unpack_from("<HH", extra, end)
+        if header_id == 0 or end + 4 + size > len(extra):
+            break
+        end += 4 + size
+    return extra[:end]
+
+
+def entry_alignment(name: bytes, method: int, data_offset: int) -> int:
+    """Keep the alignment zipalign gave stored entries (4096 for .so, otherwise 4)."""
+    if method != ZIP_STORED:
+        return 1
+    if name.endswith(b".so") and data_offset % 4096 == 0:
+        return 4096
+    if data_offset % 4 == 0:
+        return 4
+    return 1
+
+
+def rewrite_zip(apk_path: str, output_path: str, write_entry) -> None:
+    """
+    Copy an APK (or ZIP/JAR) entry by entry, in its original order, without recompressing it.
+
+    Parameters:
+    apk_path (str): The path to the input archive.
+    output_path (str): The path of the new archive, removed again if the rewrite fails.
+    write_entry (callable): Called as write_entry(zip_file, info, dst) for every entry. It either
+        writes new data for the entry to dst and returns its (method, CRC-32, compressed size,
+        size), or returns None to copy the entry raw.
+
+    Raises:
+    ZipRewriteError: If the input is not a valid ZIP file, needs ZIP64 or would be overwritten.
+
+    Note:
+    Stored entries keep their zipalign alignment and data descriptors are folded into the
+    local headers. The APK Signing Block is dropped, so the output has to be re-signed.
+    """
+    if os.path.exists(output_path) and os.path.samefile(apk_path, output_path):
+        raise ZipRewriteError("Output APK must differ from the input APK")
+    try:
+        src_zip = ZipFile(apk_path)
+    except BadZipFile as e:
+        raise ZipRewriteError(f"Invalid APK file: {apk_path} ({e})") from e
+
+    try:
+        with src_zip, open(apk_path, "rb") as src, open(output_path, "wb") as dst:
+            _rewrite_entries(src_zip, src, dst, write_entry)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(output_path)
+        raise
+
+
+def _rewrite_entries(src_zip, src, dst, write_entry):
+    central_directory = []
+    for info in src_zip.infolist():
+        src.seek(info.header_offset)
+        local_header = ZIP_LOCAL_HEADER.unpack(src.read(ZIP_LOCAL_HEADER.size))
+        if local_header[0] != ZIP_LOCAL_HEADER_SIGNATURE:
+            raise ZipRewriteError(f"Bad local header for {info.filename}")
+        (
+            _,
+            version,
+            flags,
+            method,
+            mod_time,
+            mod_date,
+            *_,
+            name_length,
+            extra_length,
+        ) = local_header
+        name = src.read(name_length)
+        extra = strip_zip_padding(src.read(extra_length))
+        data_offset = src.tell()
+        # sizes may live in a data descriptor, the central directory always has them
+        crc, compress_size, file_size = info.CRC, info.compress_size, info.file_size
+
+        header_offset = dst.tell()
+        if header_offset >= ZIP_MAX_OFFSET or file_size >= ZIP_MAX_OFFSET:
+            raise ZipRewriteError("ZIP64 archives are not supported")
+        alignment = entry_alignment(name, method, data_offset)
+        new_data_offset = header_offset + ZIP_LOCAL_HEADER.size + len(name)
+        extra += b"\0" * (-(new_data_offset + len(extra)) % alignment)
+        flags &= ~ZIP_DATA_DESCRIPTOR_FLAG
+
+        dst.write(b"\0" * (ZIP_LOCAL_HEADER.size + len(name) + len(extra)))
+        written = write_entry(src_zip, info, dst)
+        if written is not None:
+            method, crc, compress_size, file_size = written
+            if compress_size >= ZIP_MAX_OFFSET or file_size >= ZIP_MAX_OFFSET:
+                raise ZipRewriteError("ZIP64 archives are not supported")
+        else:
+            src.seek(data_offset)
+            remaining = compress_size
+            while remaining:
+                chunk = src.read(min(remaining, COPY_CHUNK_SIZE))
+                if not chunk:
+                    raise ZipRewriteError(f"Truncated entry: {info.filename}")
+                dst.write(chunk)
+                remaining -= len(chunk)
+        end_offset = dst.tell()
+
+        entry_header = (
+            version,
+            flags,
+            method,
+            mod_time,
+            mod_date,
+            crc,
+            compress_size,
+            file_size,
+            len(name),
+        )
+        dst.seek(header_offset)
+        dst.write(
+            ZIP_LOCAL_HEADER.pack(ZIP_LOCAL_HEADER_SIGNATURE, *entry_header, len(extra))
+            + name
+            + extra
+        )
+        dst.seek(end_offset)
+        central_directory.append((info, entry_header, name, header_offset))
+
+    central_offset = dst.tell()
+    for info, entry_header, name, header_offset in central_directory:
+        dst.write(
+            ZIP_CENTRAL_HEADER.pack(
+                ZIP_CENTRAL_HEADER_SIGNATURE,
+                info.create_version | info.create_system << 8,
+                *entry_header,
+                len(info.extra),
+                len(info.comment),
+                0,
+                info.internal_attr,
+                info.external_attr,
+                header_offset,
+            )
+            + name
+            + info.extra
+            + info.comment
+        )
+    central_size = dst.tell() - central_offset
+    if central_offset + central_size >= ZIP_MAX_OFFSET:
+        raise ZipRewriteError("ZIP64 archives are not supported")
+    dst.write(
+        ZIP_END_RECORD.pack(
+            ZIP_END_RECORD_SIGNATURE,
+            0,
+            0,
+            len(central_directory),
+            len(central_directory),
+            central_size,
+            central_offset,
+            len(src_zip.comment),
+        )
+        + src_zip.comment
+    )
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Benchmark the exodus YARA engine against the literal (Aho-Corasick) engine.
+#
+# usage: python3 benchmarks/bench_exodus_engines.py app1.apk app2.apk \
+#            --rules trackers.yara --trackers trackers.json
+#
+# Generate both inputs once with `exodus.py -g`, trackers.yara.trackers.json is
+# the tracker list saved next to the rules. No cache is used, every run scans
+# every entry. Each engine's hits (APK, DEX and ELF level) are compared with the
+# YARA engine's.
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exodus  # noqa: E402
+
+
+def bench(apks, rules):
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for apk in apks:
+            results[apk] = exodus.to_json(exodus.scan_apk(apk, None, rules, quiet=True))
+        elapsed = time.perf_counter() - start
+    return elapsed, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark exodus engines")
+    parser.add_argument("apk", nargs="+", help="APK files to scan")
+    parser.add_argument("-r", "--rules", default="trackers.yara")
+    parser.add_argument("-t", "--trackers", help="Exodus trackers JSON")
+    args = parser.parse_args()
+
+    trackers = exodus.load_trackers(args.rules, args.trackers)
+    engines = [("yara", exodus.load_rules(args.rules, None))]
+    engines.append(("literal", exodus.LiteralEngine(trackers)))
+    if exodus.load_ahocorasick():
+        accelerated = exodus.ahocorasick
+        exodus.ahocorasick = False  # not installed, as far as exodus knows
+        engines.append(("literal-py", exodus.LiteralEngine(trackers)))
+        exodus.ahocorasick = accelerated
+
+    print(f"{'engine':<12} {'seconds':>9} {'speedup':>8}  same hits as yara")
+    baseline = yara_hits = None
+    for name, rules in engines:
+        elapsed, results = bench(args.apk, rules)
+        baseline = baseline or elapsed
+        yara_hits = yara_hits or results
+        same = results == yara_hits
+        print(f"{name:<12} {elapsed:>9.2f} {baseline / elapsed:>7.2f}x  {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Benchmark the tgpatcher / ssl_patch regex stage with different --jobs values.
+#
+# usage: python3 benchmarks/bench_regex_jobs.py Telegram/ --jobs 1 2 4 8
+#
+# The decompiled tree is copied to a temporary directory for every run, so the
+# source tree is never modified and every run patches the same input.
+
+import argparse
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ssl_patch  # noqa: E402
+import tgpatcher  # noqa: E402
+
+
+def run_tgpatcher(root_directory):
+    with tgpatcher.regex_batch():
+        tgpatcher.apply_isRestrictedMessage(root_directory)
+        tgpatcher.apply_enableSavingMedia(root_directory)
+        tgpatcher.apply_premiumLocked(root_directory)
+        tgpatcher.apply_EnableScreenshots(root_directory)
+        tgpatcher.apply_EnableScreenshots2(root_directory)
+    tgpatcher.commit_patch_plan()
+
+
+def run_ssl_patch(root_directory, jobs):
+    ssl_patch.apply_regex(
+        root_directory,
+        ssl_patch.OKHTTP3_SEARCH_REGEX,
+        ssl_patch.OKHTTP3_REPLACE_REGEX,
+        jobs,
+        ssl_patch.OKHTTP3_ANCHORS,
+    )
+    ssl_patch.apply_regex(
+        root_directory,
+        ssl_patch.JAVAX_SEARCH_REGEX,
+        ssl_patch.JAVAX_REPLACE_REGEX,
+        jobs,
+        ssl_patch.JAVAX_ANCHORS,
+    )
+
+
+def bench(source, func):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root_directory = os.path.join(temp_dir, "tree")
+        shutil.copytree(source, root_directory)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            func(root_directory)
+            elapsed = time.perf_counter() - start
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark smali regex patching")
+    parser.add_argument("dir", help="Decompiled (smali) directory")
+    parser.add_argument(
+        "-j", "--jobs", nargs="+", type=int, default=[1, os.cpu_count() or 1]
+    )
+    args = parser.parse_args()
+
+    print(f"{'stage':<12} {'jobs':>4} {'seconds':>9} {'speedup':>8}")
+    for name in ("tgpatcher", "ssl_patch"):
+        baseline = None
+        for jobs in args.jobs:
+            if name == "tgpatcher":
+                tgpatcher.JOBS = jobs
+                func = run_tgpatcher
+            else:
+                func = lambda root, jobs=jobs: run_ssl_patch(root, jobs)  # noqa: E731
+            elapsed = bench(args.dir, func)
+            baseline = baseline or elapsed
+            print(f"{name:<12} {jobs:>4} {elapsed:>9.2f} {baseline / elapsed:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
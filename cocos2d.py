@@ -1,35 +1,652 @@
 import os
-from zlib import decompress, MAX_WBITS, error as zlib_err
-from xxtea import decrypt as xdec
+import re
+import json
+import mmap
+import shutil
+import hashlib
+import argparse
+import zipfile
+from bisect import bisect_left
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from zlib import (
+    compressobj,
+    crc32,
+    decompress,
+    DEFLATED,
+    MAX_WBITS,
+    Z_DEFAULT_COMPRESSION,
+    error as zlib_err,
+)
+from xxtea import decrypt as xdec, encrypt as xenc
+from apkzip import ZipRewriteError, rewrite_zip
 
+SCRIPT_EXTENSIONS = {".jsc": ".js", ".luac": ".lua"}
+APK_EXTENSIONS = (".apk", ".zip")
+GZIP_MAGIC = b"\x1f\x8b"
+LUA_BYTECODE_MAGIC = (b"\x1bLua", b"\x1bLJ")
+DEFAULT_SIGN = "XXTEA"
+NATIVE_LIBS = ("libcocos2djs.so", "libcocos2dlua.so")
+XXTEA_REF_PATTERN = re.compile(rb"xxtea", re.IGNORECASE)
+KEY_STRING_PATTERN = re.compile(rb"(?<=\x00)[\x20-\x7e]{4,64}(?=\x00)")
+MAX_KEY_CANDIDATES = 20000
+KEY_SAMPLE_FILES = 3
+KEY_CHUNK_SIZE = 1024
+TEXT_WHITESPACE = str.maketrans("", "", "\t\n\r")
+MANIFEST_NAME = ".cocos2d-manifest.json"
 
-def decrypt(file_path: str, key: str) -> None:
-    ext = ".js"
-    file_name = file_path.split(os.sep)[-1]
 
-    with open(file_path, "rb") as file:
-        encrypted_data = file.read()
+class Cocos2dError(Exception):
+    pass
 
-    decrypted_data = xdec(encrypted_data, key, False)
 
-    if len(decrypted_data) == 0:
-        exit("Bad Key or File not encrypted!")
+def xxtea_key(key) -> bytes:
+    # xxtea wants exactly 16 bytes, cocos2d zero pads shorter keys the same way
+    if isinstance(key, str):
+        key = key.encode()
+    return key[:16].ljust(16, b"\0")
 
+
+def gunzip(data: bytes) -> bytes:
     try:
-        decompressed = decompress(decrypted_data, 16+MAX_WBITS)
-        decrypted_data = decompressed
+        return decompress(data, 16 + MAX_WBITS)
     except zlib_err:
-        pass
+        return data
+
+
+def is_plain(data: bytes) -> bool:
+    # scripts shipped without encryption: gzip, lua bytecode or plain UTF-8 source
+    if data.startswith(LUA_BYTECODE_MAGIC):
+        return True
+    if data.startswith(GZIP_MAGIC):
+        return gunzip(data) is not data
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def xxtea_decrypt(data: bytes, key) -> bytes:
+    decrypted_data = xdec(data, xxtea_key(key), False)
+    # cocos2d appends the plain length as a last little endian word, see xxtea_to_uint_array()
+    if len(decrypted_data) >= 8:
+        size = int.from_bytes(decrypted_data[-4:], "little")
+        if len(decrypted_data) - 7 <= size <= len(decrypted_data) - 4:
+            return decrypted_data[:size]
+    return decrypted_data
+
+
+def xxtea_encrypt(data: bytes, key) -> bytes:
+    padded = data + b"\0" * (-len(data) % 4) + len(data).to_bytes(4, "little")
+    return xenc(padded, xxtea_key(key), False)
+
+
+def gzip(data: bytes) -> bytes:
+    compressor = compressobj(9, DEFLATED, 16 + MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decrypt_data(encrypted_data: bytes, key, unzip: bool = True) -> bytes:
+    decrypted_data = xxtea_decrypt(encrypted_data, key)
+    if len(decrypted_data) == 0:
+        raise ValueError("Bad Key or File not encrypted!")
+    if unzip:
+        decrypted_data = gunzip(decrypted_data)
+    return decrypted_data
+
+
+def strip_sign(data: bytes, sign: str) -> bytes:
+    # cocos2d-lua prepends the sign set with setXXTEAKeyAndSign to encrypted scripts
+    if sign and data.startswith(sign.encode()):
+        return data[len(sign) :]
+    return data
+
+
+def decrypt_script(
+    data: bytes, key, unzip: bool = True, sign: str = DEFAULT_SIGN
+) -> tuple:
+    # the record says how to turn the output back into the original script, see encrypt_script()
+    plain = is_plain(data)
+    signed = not plain and bool(sign) and data.startswith(sign.encode())
+    if not plain:
+        data = decrypt_data(strip_sign(data, sign), key, False)
+    unzipped = gunzip(data) if unzip else data
+    record = {"plain": plain, "gzip": unzipped is not data, "sign": signed}
+    record["sha256"] = hashlib.sha256(unzipped).hexdigest()
+    return unzipped, record
+
+
+def encrypt_script(data: bytes, key, record: dict, sign: str = DEFAULT_SIGN) -> bytes:
+    if record["gzip"]:
+        data = gzip(data)
+    if record["plain"]:
+        return data
+    data = xxtea_encrypt(data, key)
+    if record["sign"]:
+        data = sign.encode() + data
+    return data
+
 
+def status_of(record: dict) -> str:
+    return "plain" if record["plain"] else "decrypted"
+
+
+def decrypted_name(name: str):
+    stem, ext = os.path.splitext(name)
+    if ext in SCRIPT_EXTENSIONS:
+        return stem + SCRIPT_EXTENSIONS[ext]
+    return None
+
+
+def decrypt(file_path: str, key: str, sign: str = DEFAULT_SIGN) -> None:
+    ext = SCRIPT_EXTENSIONS.get(os.path.splitext(file_path)[1], ".js")
+    file_name = file_path.split(os.sep)[-1]
+    with open(file_path, "rb") as file:
+        encrypted_data = file.read()
+    try:
+        decrypted_data = decrypt_data(strip_sign(encrypted_data, sign), key)
+    except ValueError as e:
+        raise Cocos2dError(str(e)) from e
     with open(f"{file_name}{ext}", "wb") as file:
         file.write(decrypted_data)
-
     print(f"[*] Output: {file_name}{ext}")
 
 
-if __name__ == "__main__":
-    file_path: str = input("[?] File Path: ")
-    key: str = input("[?] Key: ")
-    if file_path and key:
-        decrypt(file_path, key)
+def find_encrypted(input_dir: str, output_dir: str):
+    # (source, destination) pairs, the output mirrors the input layout
+    output_dir = os.path.abspath(output_dir)
+    for root, dirs, files in os.walk(input_dir):
+        dirs[:] = sorted(
+            d for d in dirs if os.path.abspath(os.path.join(root, d)) != output_dir
+        )
+        for name in sorted(files):
+            if decrypted_name(name) is None:
+                continue
+            src = os.path.join(root, name)
+            rel = os.path.relpath(src, input_dir)
+            yield src, os.path.join(output_dir, decrypted_name(rel))
+
+
+def native_lib(input_dir: str):
+    for root, dirs, files in os.walk(input_dir):
+        for name in NATIVE_LIBS:
+            if name in files:
+                return os.path.join(root, name)
+    return None
+
+
+def apk_native_lib(z: zipfile.ZipFile):
+    for info in z.infolist():
+        if os.path.basename(info.filename) in NATIVE_LIBS:
+            return info
+    return None
+
+
+def key_candidates(data) -> list:
+    # printable strings of the library, closest to an xxtea reference first
+    refs = [m.start() for m in XXTEA_REF_PATTERN.finditer(data)]
+    strings = [(m.start(), m.group()) for m in KEY_STRING_PATTERN.finditer(data)]
+
+    def distance(offset):
+        i = bisect_left(refs, offset)
+        return min(abs(offset - refs[j]) for j in (i - 1, i) if 0 <= j < len(refs))
+
+    if refs:
+        strings.sort(key=lambda item: distance(item[0]))
+    candidates = list(dict.fromkeys(string for _, string in strings))
+    return [c.decode("ascii") for c in candidates[:MAX_KEY_CANDIDATES]]
+
+
+def process_pool(jobs: int):
+    # None where worker processes can't start (no sem_open on Termux/Android), the caller runs alone
+    try:
+        return ProcessPoolExecutor(max_workers=jobs)
+    except (ImportError, NotImplementedError, OSError) as e:
+        print(f"[!] Can't start {jobs} worker processes ({e}), running in this process")
+        return None
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def key_samples(
+    scripts: list, sign: str = DEFAULT_SIGN, count: int = KEY_SAMPLE_FILES
+) -> list:
+    # scripts are (size, read) pairs, the smallest encrypted ones decrypt fastest
+    samples = []
+    for _, read in sorted(scripts, key=lambda script: script[0]):
+        data = read()
+        if is_plain(data):
+            continue
+        data = strip_sign(data, sign)
+        if len(data) >= 8 and len(data) % 4 == 0:
+            samples.append(data)
+            if len(samples) == count:
+                break
+    return samples
+
+
+def decrypts(data: bytes, key) -> bool:
+    # the sample decrypts to gzip or UTF-8 javascript
+    try:
+        decrypted_data = xxtea_decrypt(data, key)
+        if decrypted_data.startswith(GZIP_MAGIC + b"\x08"):
+            return True
+        text = decrypted_data.rstrip(b"\0").decode("utf-8")
+    except (ValueError, UnicodeDecodeError):
+        return False
+    return text.translate(TEXT_WHITESPACE).isprintable()
+
+
+def score_keys(keys: list, data: bytes) -> list:
+    return [decrypts(data, key) for key in keys]
+
+
+def find_key(lib_data, samples: list, jobs: int = 1):
+    candidates = key_candidates(lib_data)
+    print(f"[*] Trying {len(candidates)} key candidates on {len(samples)} samples")
+    if not candidates or not samples:
+        return None
+    keys = [xxtea_key(candidate) for candidate in candidates]
+    scores = [0] * len(candidates)
+    alive = list(range(len(candidates)))
+    executor = None
+    if jobs > 1 and len(candidates) > KEY_CHUNK_SIZE:
+        executor = process_pool(jobs)
+    try:
+        # one sample at a time over every candidate still able to win, smallest sample first
+        for i, data in enumerate(samples):
+            chunks = [
+                [keys[j] for j in alive[k : k + KEY_CHUNK_SIZE]]
+                for k in range(0, len(alive), KEY_CHUNK_SIZE)
+            ]
+            scorer = partial(score_keys, data=data)
+            if executor is not None and len(chunks) > 1:
+                hits = executor.map(scorer, chunks)
+            else:
+                hits = map(scorer, chunks)
+            for j, hit in zip(alive, (hit for chunk in hits for hit in chunk)):
+                scores[j] += hit
+            left = len(samples) - i - 1
+            top = max(scores[j] for j in alive)
+            alive = [j for j in alive if scores[j] + left >= top]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    best = max(alive, key=scores.__getitem__)
+    if scores[best] == 0:
+        return None
+    print(f"[*] Best key decrypts {scores[best]}/{len(samples)} samples")
+    return candidates[best]
+
+
+def decrypt_file(task) -> tuple:
+    src, dst, key, unzip, sign = task
+    try:
+        data, record = decrypt_script(read_file(src), key, unzip, sign)
+        os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+        with open(dst, "wb") as file:
+            file.write(data)
+    except (ValueError, OSError) as e:
+        return src, "failed", str(e), None
+    return src, status_of(record), None, record
+
+
+def decrypt_dir(
+    input_dir: str,
+    output_dir: str,
+    key: str,
+    jobs: int = 1,
+    unzip: bool = True,
+    sign: str = DEFAULT_SIGN,
+) -> dict:
+    tasks = [
+        (src, dst, key, unzip, sign)
+        for src, dst in find_encrypted(input_dir, output_dir)
+    ]
+    print(f"[*] Found {len(tasks)} encrypted scripts in {input_dir}")
+    executor = None
+    if jobs > 1 and len(tasks) > 1:
+        executor = process_pool(jobs)
+    if executor is not None:
+        with executor:
+            results = list(executor.map(decrypt_file, tasks, chunksize=16))
+    else:
+        results = [decrypt_file(task) for task in tasks]
+
+    manifest = {
+        os.path.relpath(src, input_dir).replace(os.sep, "/"): record
+        for src, _, _, record in results
+        if record
+    }
+    write_manifest(output_dir, manifest)
+    return print_summary(results, output_dir)
+
+
+def write_manifest(output_dir: str, manifest: dict) -> None:
+    # hashes of the decrypted scripts, repack_apk() only encrypts the ones edited since
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+
+
+def load_manifest(tree: str) -> dict:
+    path = os.path.join(tree, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def print_summary(results, output: str) -> dict:
+    summary = {"decrypted": 0, "plain": 0, "failed": 0}
+    for src, status, error, _ in results:
+        summary[status] += 1
+        if error:
+            print(f"[!] {src}: {error}")
+    print(f"[*] Output: {output}")
+    print(
+        f"[*] Decrypted: {summary['decrypted']}, already plain: {summary['plain']}, failed: {summary['failed']}"
+    )
+    return summary
+
+
+def decrypt_apk(
+    apk_path: str, output: str, key: str, unzip: bool = True, sign: str = DEFAULT_SIGN
+) -> dict:
+    # scripts are read, decrypted and written one entry at a time, nothing is extracted
+    to_zip = output.lower().endswith(APK_EXTENSIONS)
+    created = not os.path.exists(output)
+    try:
+        results = decrypt_entries(apk_path, output, to_zip, key, unzip, sign)
+    except BaseException:
+        # a half written output would pass for a complete one, repack_apk() would trust its manifest
+        if to_zip:
+            remove_output(output)
+        elif created:
+            shutil.rmtree(output, ignore_errors=True)
+        raise
+    return print_summary(results, output)
+
+
+def remove_output(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def decrypt_entries(
+    apk_path: str, output: str, to_zip: bool, key: str, unzip: bool, sign: str
+) -> list:
+    output_root = os.path.abspath(output)
+    results = []
+    manifest = {}
+    try:
+        z = zipfile.ZipFile(apk_path)
+    except zipfile.BadZipFile as e:
+        raise Cocos2dError(f"Invalid APK file: {apk_path} ({e})") from e
+    with z:
+        entries = [
+            info
+            for info in z.infolist()
+            if not info.is_dir() and decrypted_name(info.filename)
+        ]
+        print(f"[*] Found {len(entries)} encrypted scripts in {apk_path}")
+        if to_zip:
+            out_zip = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED)
+        else:
+            out_zip = None
+        try:
+            for info in entries:
+                name = decrypted_name(info.filename)
+                try:
+                    data, record = decrypt_script(z.read(info), key, unzip, sign)
+                    if out_zip is not None:
+                        out_zip.writestr(name, data)
+                    else:
+                        dst = os.path.abspath(os.path.join(output_root, name))
+                        if not dst.startswith(output_root + os.sep):
+                            raise ValueError("entry escapes the output directory")
+                        os.makedirs(os.path.dirname(dst), exist_ok=True)
+                        with open(dst, "wb") as file:
+                            file.write(data)
+                except (ValueError, OSError, zipfile.BadZipFile, zlib_err) as e:
+                    results.append((info.filename, "failed", str(e), None))
+                else:
+                    results.append((info.filename, status_of(record), None, record))
+                    manifest[info.filename] = record
+            if out_zip is not None:
+                out_zip.writestr(
+                    MANIFEST_NAME, json.dumps(manifest, indent=1, sort_keys=True)
+                )
+            else:
+                write_manifest(output, manifest)
+        finally:
+            if out_zip is not None:
+                out_zip.close()
+    return results
+
+
+def repacked_script(
+    z: zipfile.ZipFile,
+    info,
+    tree: str,
+    key: str,
+    sign: str,
+    manifest: dict,
+    unzip: bool,
+):
+    # the encrypted script for an edited tree file, None when it is missing or unchanged
+    path = os.path.join(tree, decrypted_name(info.filename))
+    if not os.path.isfile(path):
+        return None
+    data = read_file(path)
+    record = manifest.get(info.filename)
+    if record is None:
+        _, record = decrypt_script(z.read(info), key, unzip, sign)
+    if hashlib.sha256(data).hexdigest() == record["sha256"]:
+        return None
+    return encrypt_script(data, key, record, sign)
+
+
+def repack_apk(
+    apk_path: str,
+    tree: str,
+    key: str,
+    output: str,
+    sign: str = DEFAULT_SIGN,
+    unzip: bool = None,
+) -> dict:
+    # edited scripts are encrypted again, every other entry is copied raw in its original order
+    if unzip is None and not os.path.isfile(os.path.join(tree, MANIFEST_NAME)):
+        # without it a --no-gunzip tree can't be told apart and its scripts would be gzipped twice
+        raise Cocos2dError(
+            f"{MANIFEST_NAME} not found in {tree}, pass --no-manifest "
+            "(and --no-gunzip if the tree was decrypted with it)"
+        )
+    manifest = load_manifest(tree)
+    summary = {"encrypted": 0, "copied": 0}
+
+    def write_entry(z: zipfile.ZipFile, info, dst):
+        data = None
+        if not info.is_dir() and decrypted_name(info.filename):
+            data = repacked_script(
+                z, info, tree, key, sign, manifest, unzip is not False
+            )
+        if data is None:
+            summary["copied"] += 1
+            return None
+        summary["encrypted"] += 1
+        print(f"[*] Encrypted: {info.filename}")
+        crc, file_size = crc32(data), len(data)
+        method = zipfile.ZIP_STORED
+        if info.compress_type != zipfile.ZIP_STORED:
+            method = zipfile.ZIP_DEFLATED
+            compressor = compressobj(Z_DEFAULT_COMPRESSION, DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+        dst.write(data)
+        return method, crc, len(data), file_size
+
+    try:
+        rewrite_zip(apk_path, output, write_entry)
+    except ZipRewriteError as e:
+        raise Cocos2dError(str(e)) from e
+    print(f"[*] Output: {output} (re-sign it before installing)")
+    print(f"[*] Re-encrypted: {summary['encrypted']}, copied: {summary['copied']}")
+    return summary
+
+
+def find_key_for(file_path: str, is_apk: bool, args):
+    jobs = max(1, args.jobs)
+    if is_apk:
+        with zipfile.ZipFile(file_path) as z:
+            scripts = [
+                (info.file_size, partial(z.read, info))
+                for info in z.infolist()
+                if decrypted_name(info.filename)
+            ]
+            samples = key_samples(scripts, args.sign)
+            if args.lib:
+                lib_data = read_file(args.lib)
+            else:
+                lib = apk_native_lib(z)
+                if lib is None:
+                    raise Cocos2dError(
+                        f"{' / '.join(NATIVE_LIBS)} not found, pass it with --lib"
+                    )
+                lib_data = z.read(lib)
+        return find_key(lib_data, samples, jobs)
+
+    lib_path = args.lib or (native_lib(file_path) if os.path.isdir(file_path) else None)
+    if not lib_path:
+        raise Cocos2dError(f"{' / '.join(NATIVE_LIBS)} not found, pass it with --lib")
+    if os.path.isdir(file_path):
+        scripts = [
+            (os.path.getsize(src), partial(read_file, src))
+            for src, _ in find_encrypted(file_path, file_path)
+        ]
+    else:
+        scripts = [(0, partial(read_file, file_path))]
+    samples = key_samples(scripts, args.sign)
+    with open(lib_path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as lib_data:
+        return find_key(lib_data, samples, jobs)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Decrypt cocos2d encrypted .jsc / .luac files"
+    )
+    parser.add_argument(
+        "path",
+        nargs="?",
+        help=".jsc/.luac file, APK or extracted game/assets directory",
+    )
+    parser.add_argument("-k", "--key", help="XXTEA key")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Output directory, .zip for APK input or the repacked APK (default: <path>_decrypted / _repacked.apk)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Worker processes for directories",
+    )
+    parser.add_argument(
+        "-f",
+        "--find-key",
+        action="store_true",
+        help="Recover the key from the game's native library",
+    )
+    parser.add_argument(
+        "-L",
+        "--lib",
+        help="libcocos2djs.so / libcocos2dlua.so for --find-key (default: searched in the directory)",
+    )
+    parser.add_argument(
+        "-r",
+        "--repack",
+        metavar="TREE",
+        help="Encrypt the edited scripts of a decrypted TREE back into the APK",
+    )
+    parser.add_argument(
+        "-s",
+        "--sign",
+        default=DEFAULT_SIGN,
+        help=f"Sign prefixed to encrypted lua scripts (default: {DEFAULT_SIGN})",
+    )
+    parser.add_argument(
+        "--no-gunzip",
+        action="store_true",
+        help="Keep gzip compressed scripts compressed",
+    )
+    parser.add_argument(
+        "--no-manifest",
+        action="store_true",
+        help=f"Repack a TREE without {MANIFEST_NAME}, add --no-gunzip if it was decrypted with it",
+    )
+    args = parser.parse_args()
+    try:
+        run(args)
+    except Cocos2dError as e:
+        exit(f"[!] {e}")
+
+
+def run(args) -> None:
+    file_path = args.path or input("[?] File Path: ")
+    is_apk = (
+        bool(file_path)
+        and os.path.isfile(file_path)
+        and file_path.lower().endswith(APK_EXTENSIONS)
+    )
+    key = args.key
+    if not key and args.find_key and file_path:
+        key = find_key_for(file_path, is_apk, args)
+        if not key:
+            exit("[!] No key candidate decrypts the samples")
+        print(f"[+] Key: {key}")
+    key = key or input("[?] Key: ")
+    if not (file_path and key):
+        return
+    base = file_path.rstrip(os.sep)
+    if is_apk:
+        base = os.path.splitext(base)[0]
+    if args.repack:
+        if not is_apk:
+            exit("[!] --repack needs the original APK as path")
+        unzip = not args.no_gunzip if args.no_manifest else None
+        repack_apk(
+            file_path,
+            args.repack,
+            key,
+            args.output or base + "_repacked.apk",
+            args.sign,
+            unzip,
+        )
         print("[+] All Done!")
+        return
+    output = args.output or base + "_decrypted"
+    if is_apk:
+        summary = decrypt_apk(file_path, output, key, not args.no_gunzip, args.sign)
+    elif os.path.isdir(file_path):
+        summary = decrypt_dir(
+            file_path, output, key, max(1, args.jobs), not args.no_gunzip, args.sign
+        )
+    else:
+        decrypt(file_path, key, args.sign)
+        summary = {"failed": 0}
+    if summary["failed"]:
+        exit(1)
+    print("[+] All Done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,30 @@
+from __future__ import annotations
+
 import argparse
+import bisect
+import contextlib
+import functools
+import hashlib
 import importlib
-import io
 import json
+import mmap
 import os
 import re
+import struct
 import sys
-import urllib.error
-import urllib.request
-import zipfile
-from collections import defaultdict
+import threading
+import time
+from collections import defaultdict, deque
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import zipfile
+
+# Heavy or optional modules are imported on first use (see load_yara() and
+# load_ahocorasick(), the rest are imported where they are needed), so that
+# --help and --gen start fast
+yara = None
+ahocorasick = None
 
 # Define color codes
 RED = "\033[0;31m"
@@ -22,42 +38,115 @@ NC = "\033[0m"  # No Color
 APK_MAGIC = b"PK\x03\x04"
 DEX_MAGIC = b"dex\n"
 ELF_MAGIC = b"\x7fELF"
+MAGIC_SIZE = 4
+# DEX/ELF entries up to this size are matched in memory, bigger ones from a temporary file
+SCAN_MEMORY_LIMIT = 64 * 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+SEARCH_CHUNK_SIZE = 16 * 1024 * 1024
+APK_EXTENSIONS = (".apk", ".apks", ".xapk")
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "exodus"
+)
+SCAN_CACHE_SIZE = 10000
+
+
+TRACKERS_URL = "https://reports.exodus-privacy.eu.org/api/trackers"
+RULE_NAME_PATTERN = re.compile(r"^rule (\w+) : tracker$", re.MULTILINE)
+REGEX_METACHARACTERS = re.compile(r"[\\^$*+?()\[\]{}|]")
+# ref: https://source.android.com/docs/core/runtime/dex-format#header-item
+DEX_STRING_IDS = struct.Struct("<II")  # string_ids_size, string_ids_off
+DEX_STRING_IDS_OFFSET = 0x38
+# ref: https://refspecs.linuxfoundation.org/elf/gabi4+/ch4.eheader.html
+ELF_SCAN_SECTIONS = (".rodata", ".dynstr", ".dynsym")
+ELF_SHT_NOBITS = 8
+
+
+def fetch_trackers(source: str | None = None):
+    """
+    Load the Exodus trackers, from the API or from a local copy of its JSON response
+    :param source: path to a saved API response, None to query the API
+    :return: trackers dict keyed by tracker id, or None when the API is unreachable
+    """
+    if source:
+        with open(source, "r") as f:
+            return json.load(f).get("trackers")
 
+    import urllib.error
+    import urllib.request
 
-def gen_rule():
-    """Generate YARA rules from Exodus API."""
-    url = "https://reports.exodus-privacy.eu.org/api/trackers"
     try:
-        with urllib.request.urlopen(url) as response:
+        with urllib.request.urlopen(TRACKERS_URL) as response:
             data_bytes = response.read()
         data = json.loads(data_bytes)
     except urllib.error.URLError:
-        print(f"Error connecting to {url}. Skipping rule generation.", file=sys.stderr)
-        return
+        print(
+            f"Error connecting to {TRACKERS_URL}. Skipping rule generation.",
+            file=sys.stderr,
+        )
+        return None
+    return data.get("trackers")
 
-    trackers = data.get("trackers")
-
-    for _, info in trackers.items():
-        code_signature = info.get("code_signature")
-        network_signature = info.get("network_signature")
-        if network_signature == "\\.facebook\\.com":
-            network_signature = ""
-        if info.get("name") == "Google Ads":
-            network_signature = ""
-            code_signature = "com.google.android.gms.ads.identifier"
-        code_signature = code_signature.replace(".", "\\.").replace("/", r"\\")
-        network_signature = network_signature.replace("/", r"\\")
-        code_signature2 = code_signature.replace(".", "/")
-        if not code_signature and not network_signature:
-            continue
-        rule_name = re.sub(
-            r"[^a-zA-Z]", "_", info.get("name").strip().replace(" ", "_")
-        ).replace("__", "_")
-        if rule_name.endswith("_"):
-            rule_name = rule_name[:-1]
-        rule_name = rule_name.lower()
-
-        yara_rule = f"""
+
+def tracker_signatures(info):
+    """
+    Rule name and signatures of a single tracker, with our Exodus overrides applied
+    :return: (rule name, code signature, network signature), or None if the
+             tracker has no signature
+    """
+    code_signature = info.get("code_signature")
+    network_signature = info.get("network_signature")
+    if network_signature == "\\.facebook\\.com":
+        network_signature = ""
+    if info.get("name") == "Google Ads":
+        network_signature = ""
+        code_signature = "com.google.android.gms.ads.identifier"
+    if not code_signature and not network_signature:
+        return None
+    rule_name = re.sub(
+        r"[^a-zA-Z]", "_", info.get("name").strip().replace(" ", "_")
+    ).replace("__", "_")
+    if rule_name.endswith("_"):
+        rule_name = rule_name[:-1]
+    return rule_name.lower(), code_signature, network_signature
+
+
+def tracker_patterns(info):
+    """
+    Regexes of the strings in a tracker's YARA rule, shared by both engines
+    :return: (rule name, {string type: regex}), or None if the tracker has no
+             signature
+    """
+    signatures = tracker_signatures(info)
+    if signatures is None:
+        return None
+    rule_name, code_signature, network_signature = signatures
+    code_signature = code_signature.replace(".", "\\.").replace("/", r"\\")
+    network_signature = network_signature.replace("/", r"\\")
+    code_signature2 = code_signature.replace(".", "/")
+    patterns = {
+        "code_signature": code_signature,
+        "network_signature": network_signature,
+        "code_signature2": code_signature2,
+    }
+    return rule_name, {
+        rule_type: regex for rule_type, regex in patterns.items() if regex
+    }
+
+
+def tracker_rule(info):
+    """
+    Generate the YARA rule of a single tracker
+    :return: (rule name, rule source), or None if the tracker has no signature
+    """
+    patterns = tracker_patterns(info)
+    if patterns is None:
+        return None
+    rule_name, patterns = patterns
+    code_signature = patterns.get("code_signature")
+    network_signature = patterns.get("network_signature")
+    code_signature2 = patterns.get("code_signature2")
+
+    yara_rule = f"""
 rule {rule_name} : tracker
 {{
     meta:
@@ -67,28 +156,106 @@ rule {rule_name} : tracker
 
     strings:
 """
-        if code_signature:
-            yara_rule += f"        $code_signature    = /{code_signature}/"
-        if network_signature:
-            yara_rule += f"\n        $network_signature = /{network_signature}/"
-        if code_signature2:
-            yara_rule += f"\n        $code_signature2   = /{code_signature2}/"
+    if code_signature:
+        yara_rule += f"        $code_signature    = /{code_signature}/"
+    if network_signature:
+        yara_rule += f"\n        $network_signature = /{network_signature}/"
+    if code_signature2:
+        yara_rule += f"\n        $code_signature2   = /{code_signature2}/"
 
-        yara_rule += """
+    yara_rule += """
 
     condition:
         any of them
 }
 """
-        existing_rules = ""
-        if os.path.exists("trackers.yara"):
-            with open("trackers.yara", "r") as f:
-                existing_rules = f.read()
-        if rule_name not in existing_rules:
-            with open("trackers.yara", "a") as f:
-                f.write(yara_rule)
+    return rule_name, yara_rule
+
+
+def read_rules(rules_path: str):
+    """Split a generated rules file into {rule name: rule source}"""
+    with open(rules_path, "r") as f:
+        source = f.read()
+    starts = [match.start() - 1 for match in RULE_NAME_PATTERN.finditer(source)]
+    names = RULE_NAME_PATTERN.findall(source)
+    return {
+        name: source[start:end]
+        for name, start, end in zip(names, starts, starts[1:] + [len(source)])
+    }
+
+
+def write_atomic(path: str, text: str):
+    """Write text to path through a temporary file, so readers never see a partial file"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+def gen_rule(
+    rules_path: str = "trackers.yara",
+    source: str | None = None,
+    incremental: bool = False,
+):
+    """
+    Generate YARA rules from Exodus API.
+    :param rules_path: rules file to write
+    :param source: local copy of the API response (see fetch_trackers)
+    :param incremental: only regenerate trackers that changed since the last
+                        run, diffing against the copy saved in <rules_path>.trackers.json
+    """
+    trackers = fetch_trackers(source)
+    if trackers is None:
+        return
+
+    trackers_cache = f"{rules_path}.trackers.json"
+    old_trackers = {}
+    old_rule_names = {}
+    old_rules = {}
+    if incremental and os.path.exists(rules_path) and os.path.exists(trackers_cache):
+        with open(trackers_cache, "r") as f:
+            cached = json.load(f)
+        old_trackers = cached["trackers"]
+        old_rule_names = cached["rule_names"]
+        old_rules = read_rules(rules_path)
+
+    rules = {}
+    rule_names = {}
+    changed = 0
+    for tracker_id, info in trackers.items():
+        old_name = old_rule_names.get(tracker_id)
+        unchanged = old_trackers.get(tracker_id) == info
+        changed += not unchanged
+        if unchanged and old_name in old_rules:
+            rule = old_name, old_rules[old_name]
         else:
+            rule = tracker_rule(info)
+        if rule is None:
+            continue
+        rule_name, yara_rule = rule
+        if rule_name in rules:
             print(f"Duplicate rule name found: {rule_name}. Skipping.")
+            continue
+        rules[rule_name] = yara_rule
+        rule_names[tracker_id] = rule_name
+    removed = len(old_trackers.keys() - trackers.keys())
+
+    text = "".join(rules.values())
+    cache_text = json.dumps({"trackers": trackers, "rule_names": rule_names})
+    if os.path.exists(rules_path):
+        with open(rules_path, "r") as f:
+            if f.read() == text:
+                print(f"{GREEN}{rules_path} is up to date{NC}")
+                write_atomic(trackers_cache, cache_text)
+                return
+    write_atomic(rules_path, text)
+    write_atomic(trackers_cache, cache_text)
+    if old_trackers:
+        print(
+            f"{GREEN}Updated {rules_path}:{NC} {changed} new/changed, {removed} removed tracker(s)"
+        )
+    else:
+        print(f"{GREEN}Generated {len(rules)} rule(s) in {rules_path}{NC}")
 
 
 def import_library(library_name: str, package_name: str | None = None):
@@ -116,67 +283,904 @@ def import_library(library_name: str, package_name: str | None = None):
         return importlib.import_module(library_name)
 
 
-yara = import_library("yara", "yara-python-dex")
+# (import name, PyPI package, required)
+DEPENDENCIES = [
+    ("yara", "yara-python-dex", True),
+    ("ahocorasick", "pyahocorasick", False),
+]
 
 
-def scan_apk(apk_path: str, rules_path: str):
-    """Scan APK, DEX, and ELF files (iterative, handles embedded APKs)"""
+def install_deps():
+    """Install the scan dependencies (--install-deps), never done implicitly"""
+    for library_name, package_name, required in DEPENDENCIES:
+        try:
+            import_library(library_name, package_name)
+            print(f"{GREEN}INFO:{NC} {package_name} is installed")
+        except (AssertionError, OSError, ImportError) as e:
+            level = f"{RED}ERROR:{NC}" if required else f"{YELLOW}WARN:{NC}"
+            print(f"{level} Could not install {package_name}: {e}", file=sys.stderr)
+            if required:
+                sys.exit(1)
+
+
+def load_yara():
+    """Import yara on first use"""
+    global yara
+    if yara is None:
+        try:
+            yara = importlib.import_module("yara")
+        except ImportError as e:
+            raise ImportError(
+                "yara-python-dex is not installed, run exodus.py --install-deps"
+            ) from e
+    return yara
+
+
+def load_ahocorasick():
+    """Import the optional pyahocorasick accelerator on first use, None if it isn't installed"""
+    global ahocorasick
+    if ahocorasick is None:
+        try:
+            ahocorasick = importlib.import_module("ahocorasick")
+        except ImportError:
+            ahocorasick = False
+    return ahocorasick or None
+
+
+def rules_fingerprint(rules_path: str) -> str:
+    """Hash of the rules source and the yara-python version, used as cache key"""
+    yara = load_yara()
+    with open(rules_path, "rb") as f:
+        source = f.read()
+    return hashlib.sha256(
+        source + f"\0{yara.__version__}\0{yara.YARA_VERSION}".encode()
+    ).hexdigest()
+
+
+def load_rules(rules_path: str, cache_dir: str | None = CACHE_DIR):
+    """
+    Load compiled YARA rules, compiling them only when the cache is stale
+    :param rules_path: path to the .yara source
+    :param cache_dir: directory of compiled rules, keyed on a hash of the source
+                      and the yara-python version; None disables the cache
+    :return: compiled rules
+    """
+    yara = load_yara()
+    if cache_dir is None:
+        return yara.compile(filepath=rules_path)
+
+    cache_path = os.path.join(cache_dir, f"{rules_fingerprint(rules_path)}.yarac")
+
+    if os.path.exists(cache_path):
+        try:
+            return yara.load(filepath=cache_path)
+        except yara.Error:
+            print(f"{YELLOW}WARN:{NC} Ignoring broken rules cache {cache_path}")
+
     rules = yara.compile(filepath=rules_path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        rules.save(filepath=temp_path)
+        os.replace(temp_path, cache_path)
+    except (OSError, yara.Error) as e:
+        print(f"{YELLOW}WARN:{NC} Could not cache compiled rules: {e}")
+    return rules
+
+
+def open_embedded_apk(stack: contextlib.ExitStack, z: zipfile.ZipFile, info):
+    """
+    Open an APK stored inside another APK without reading it into memory.
+    Stored entries are opened directly over the parent entry, compressed ones
+    are first spooled to a temporary file so seeking doesn't re-inflate them.
+    """
+    import shutil
+    import tempfile
+    import zipfile
+
+    if info.compress_type == zipfile.ZIP_STORED:
+        return stack.enter_context(zipfile.ZipFile(stack.enter_context(z.open(info))))
+    temp_file = stack.enter_context(tempfile.TemporaryFile())
+    with z.open(info) as f:
+        shutil.copyfileobj(f, temp_file, COPY_CHUNK_SIZE)
+    return stack.enter_context(zipfile.ZipFile(temp_file))
+
+
+def match_hits(matches):
+    """Flatten YARA matches into (rule, string type, matched string) tuples"""
+    for match in matches:
+        for _, offset, data in match.strings:
+            rule_type = str(offset).replace("$", "")
+            yield match.rule, rule_type, data.decode("utf-8", errors="ignore")
+
+
+def literal_alternatives(regex: str):
+    """
+    Split a YARA regex into its |-separated alternatives, each a list of plain
+    text fragments separated by "." wildcards
+    :return: list of fragment lists, or None if the regex needs a real regex engine
+    """
+    alternatives = [[""]]
+    escaped = False
+    for char in regex:
+        if escaped:
+            if char.isalnum():  # \d, \w, \b...
+                return None
+            alternatives[-1][-1] += char
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "|":
+            alternatives.append([""])
+        elif char == ".":
+            alternatives[-1].append("")
+        elif REGEX_METACHARACTERS.match(char):
+            return None
+        else:
+            alternatives[-1][-1] += char
+    if escaped or not all(max(fragments, key=len) for fragments in alternatives):
+        return None
+    return alternatives
+
+
+def read_dex_strings(data):
+    """Raw (MUTF-8) bytes of every string in a DEX string table"""
+    size, offset = DEX_STRING_IDS.unpack_from(data, DEX_STRING_IDS_OFFSET)
+    for (string_offset,) in struct.iter_unpack("<I", data[offset : offset + size * 4]):
+        while data[string_offset] & 0x80:  # skip the uleb128 utf16_size
+            string_offset += 1
+        string_offset += 1
+        yield data[string_offset : data.find(b"\0", string_offset)]
+
+
+def decode_mutf8(raw: bytes) -> str:
+    """Decode DEX modified UTF-8: NUL is C0 80, supplementary characters are surrogate pairs"""
+    if raw.isascii():
+        return raw.decode("ascii")
+    try:
+        text = raw.replace(b"\xc0\x80", b"\0").decode("utf-8", "surrogatepass")
+    except UnicodeDecodeError:
+        return raw.decode("utf-8", "replace")
+    return text.encode("utf-16", "surrogatepass").decode("utf-16", "replace")
+
+
+def dex_string_table(data):
+    """
+    Decoded, deduplicated strings of a DEX file. Class names need no separate
+    type_ids walk: every type_id is an index into the same string table.
+    """
+    return list(dict.fromkeys(decode_mutf8(raw) for raw in read_dex_strings(data)))
+
+
+def read_elf_sections(data, names=ELF_SCAN_SECTIONS):
+    """
+    Yield (name, memoryview) of the named sections of an ELF file, without copying them.
+    Yields nothing if the file has no section headers.
+    """
+    endian = "<" if data[5] == 1 else ">"
+    if data[4] == 2:  # ELFCLASS64
+        (shoff,) = struct.unpack_from(endian + "Q", data, 0x28)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x3A)
+        section_header = struct.Struct(endian + "IIQQQQIIQQ")
+    else:
+        (shoff,) = struct.unpack_from(endian + "I", data, 0x20)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x2E)
+        section_header = struct.Struct(endian + "IIIIIIIIII")
+    if not shoff or shstrndx >= shnum:
+        return
+
+    headers = [
+        section_header.unpack_from(data, shoff + index * shentsize)
+        for index in range(shnum)
+    ]
+    view = memoryview(data)
+    names_offset, names_size = headers[shstrndx][4:6]
+    section_names = bytes(view[names_offset : names_offset + names_size])
+    for name_offset, section_type, _, _, offset, size, *_ in headers:
+        name_end = section_names.find(b"\0", name_offset)
+        name = section_names[name_offset:name_end].decode("ascii", "replace")
+        if name in names and section_type != ELF_SHT_NOBITS:
+            yield name, view[offset : offset + size]
+
+
+def match_elf_sections(rules, sections):
+    """Match YARA rules or a LiteralEngine against ELF sections, tagging each hit with its section"""
+    hits = set()
+    for name, section in sections:
+        if isinstance(rules, LiteralEngine):
+            section_hits = rules.match(data=section)
+        else:
+            # yara-python only takes bytes, so the section (not the file) is copied
+            section_hits = match_hits(rules.match(data=bytes(section)))
+        hits.update(
+            (rule, rule_type, f"{data} [{name}]")
+            for rule, rule_type, data in section_hits
+        )
+    return list(hits)
+
+
+def map_file(stack: contextlib.ExitStack, path: str):
+    """Read-only mmap of a file, closed with the stack"""
+    f = stack.enter_context(open(path, "rb"))
+    return stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton over bytes: finds every occurrence of all patterns
+    in a single pass. Uses pyahocorasick when it is installed.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.overlap = max(map(len, patterns), default=1) - 1
+        self.accelerator = load_ahocorasick()
+        if self.accelerator:
+            # a word holds a single value: keep every index of a repeated pattern
+            indexes = defaultdict(list)
+            for index, pattern in enumerate(patterns):
+                indexes[pattern.decode("latin-1")].append(index)
+            self.automaton = self.accelerator.Automaton()
+            for word, word_indexes in indexes.items():
+                self.automaton.add_word(word, word_indexes)
+            if patterns:
+                self.automaton.make_automaton()
+            return
+
+        self.goto = [{}]
+        self.outputs = [[]]
+        for index, pattern in enumerate(patterns):
+            state = 0
+            for byte in pattern:
+                if byte not in self.goto[state]:
+                    self.goto[state][byte] = len(self.goto)
+                    self.goto.append({})
+                    self.outputs.append([])
+                state = self.goto[state][byte]
+            self.outputs[state].append(index)
+
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for byte, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and byte not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(byte, 0)
+                self.outputs[next_state] += self.outputs[self.fail[next_state]]
+
+    def search(self, data):
+        """Yield (end offset, pattern index) for every pattern occurrence in data"""
+        with memoryview(data) as view:  # iterates as ints, also for mmap
+            if self.accelerator:
+                if self.patterns:
+                    yield from self._search_chunks(view)
+                return
+
+            goto, fail, outputs = self.goto, self.fail, self.outputs
+            state = 0
+            for position, byte in enumerate(view):
+                while state and byte not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(byte, 0)
+                for index in outputs[state]:
+                    yield position, index
+
+    def _search_chunks(self, view):
+        """
+        pyahocorasick only searches str: decode SEARCH_CHUNK_SIZE bytes at a
+        time, overlapping by the longest pattern so no occurrence is cut
+        """
+        for start in range(0, len(view), SEARCH_CHUNK_SIZE):
+            chunk_start = max(start - self.overlap, 0)
+            chunk = str(view[chunk_start : start + SEARCH_CHUNK_SIZE], "latin-1")
+            for end, indexes in self.automaton.iter(chunk):
+                if chunk_start + end >= start:  # not already found in the overlap
+                    for index in indexes:
+                        yield chunk_start + end, index
+
+
+class LiteralEngine:
+    """
+    YARA-free tracker matcher with the same hits as the generated YARA rules.
+    Signatures made of plain text, "." wildcards and | go into one Aho-Corasick
+    automaton, keyed on their longest plain fragment: a wildcard hit is then
+    checked against the bytes around it. The few real regexes are matched with
+    YARA, imported when they are first needed, or with re if it isn't installed.
+    """
+
+    def __init__(self, trackers):
+        self.fingerprint = (
+            "literal-"
+            + hashlib.sha256(json.dumps(trackers, sort_keys=True).encode()).hexdigest()
+        )
+        self.literals = []
+        self.regexes = []
+        rule_names = set()
+        for info in trackers.values():
+            patterns = tracker_patterns(info)
+            if patterns is None:
+                continue
+            rule_name, patterns = patterns
+            if rule_name in rule_names:
+                continue
+            rule_names.add(rule_name)
+            for rule_type, regex in patterns.items():
+                alternatives = literal_alternatives(regex)
+                if alternatives is None:
+                    self.regexes.append((rule_name, rule_type, regex))
+                    continue
+                for fragments in alternatives:
+                    self.literals.append(
+                        literal_pattern(rule_name, rule_type, fragments)
+                    )
+
+        self.automaton = AhoCorasick([literal[0] for literal in self.literals])
+        self.regex_rules = None
+        self.regex_lock = threading.Lock()
+
+    def compile_regexes(self):
+        """YARA rules of the real regexes, or (rule, type, re pattern) if yara isn't installed"""
+        try:
+            yara = load_yara()
+        except ImportError:
+            return [
+                (rule_name, rule_type, re.compile(regex.encode()))
+                for rule_name, rule_type, regex in self.regexes
+            ]
+        strings = defaultdict(list)
+        for rule_name, rule_type, regex in self.regexes:
+            strings[rule_name].append(f"${rule_type} = /{regex}/")
+        return yara.compile(
+            source="".join(
+                f"rule {rule_name} {{ strings: {' '.join(rule_strings)} "
+                "condition: any of them }\n"
+                for rule_name, rule_strings in strings.items()
+            )
+        )
+
+    def search_regexes(self, data, path: str | None = None):
+        """Yield (offset, hit) for every match of the real regexes in data (the file at path)"""
+        if not self.regexes:
+            return
+        with self.regex_lock:
+            if self.regex_rules is None:
+                self.regex_rules = self.compile_regexes()
+        if isinstance(self.regex_rules, list):
+            for rule_name, rule_type, regex in self.regex_rules:
+                for match in regex.finditer(data):
+                    text = match.group().decode("utf-8", errors="ignore")
+                    yield match.start(), (rule_name, rule_type, text)
+            return
+        matches = (
+            self.regex_rules.match(path)
+            if path
+            else self.regex_rules.match(
+                data=data if isinstance(data, bytes) else bytes(data)
+            )
+        )
+        for match in matches:
+            for offset, identifier, text in match.strings:
+                text = text.decode("utf-8", errors="ignore")
+                yield offset, (match.rule, identifier.replace("$", ""), text)
+
+    def search(self, data, path: str | None = None):
+        """Yield (offset, hit) for every signature found in data (the file at path)"""
+        for position, index in self.automaton.search(data):
+            _, hit, size, anchor_end, wildcards = self.literals[index]
+            if wildcards is None:
+                yield position + 1 - size, hit
+                continue
+            start = position + 1 - anchor_end
+            match = (
+                wildcards.fullmatch(data, start, start + size) if start >= 0 else None
+            )
+            if match:
+                text = match.group().decode("utf-8", errors="ignore")
+                yield start, (hit[0], hit[1], text)
+        yield from self.search_regexes(data, path)
+
+    def match(self, path: str | None = None, data=None):
+        """Hits in a file or buffer, in the match_hits() format"""
+        with contextlib.ExitStack() as stack:
+            if data is None:
+                data = map_file(stack, path)
+            return list({hit for _, hit in self.search(data, path)})
+
+
+def literal_pattern(rule_name: str, rule_type: str, fragments):
+    """
+    Automaton entry of one literal_alternatives() alternative
+    :return: (longest fragment, hit, size, end of the longest fragment in the
+             alternative, wildcard pattern or None for plain text)
+    """
+    text = ".".join(fragments)
+    anchor = max(range(len(fragments)), key=lambda i: len(fragments[i]))
+    anchor_end = len(".".join(fragments[: anchor + 1]))
+    wildcards = None
+    if len(fragments) > 1:
+        wildcards = re.compile(
+            b".".join(re.escape(fragment.encode()) for fragment in fragments)
+        )
+    return (
+        fragments[anchor].encode(),
+        (rule_name, rule_type, text),
+        len(text.encode()),
+        len(text[:anchor_end].encode()),
+        wildcards,
+    )
+
+
+def load_trackers(rules_path: str, source: str | None = None):
+    """Trackers for the literal engine: from source, the gen_rule copy next to rules_path, or the API"""
+    trackers_cache = f"{rules_path}.trackers.json"
+    if not source and os.path.exists(trackers_cache):
+        with open(trackers_cache, "r") as f:
+            return json.load(f)["trackers"]
+    return fetch_trackers(source)
+
+
+def match_dex_strings(rules, data):
+    """
+    Match YARA rules or a LiteralEngine against the string table of a DEX file
+    only, instead of its code and data. Each hit reports the whole string it
+    was found in (e.g. the class descriptor) rather than the matched bytes.
+    """
+    strings = dex_string_table(data)
+    encoded = [string.encode("utf-8", "surrogatepass") for string in strings]
+    text = b"\n".join(encoded)
+    starts = []
+    start = 0
+    for string in encoded:
+        starts.append(start)
+        start += len(string) + 1
+
+    if isinstance(rules, LiteralEngine):
+        found = list(rules.search(text))
+    else:
+        found = [
+            (offset, (match.rule, identifier.replace("$", ""), None))
+            for match in rules.match(data=text)
+            for offset, identifier, _ in match.strings
+        ]
+    return list(
+        {
+            (rule, rule_type, strings[bisect.bisect_right(starts, offset) - 1])
+            for offset, (rule, rule_type, _) in found
+        }
+    )
+
+
+def match_rules(
+    rules,
+    path: str | None = None,
+    data=None,
+    dex_strings: bool = False,
+    elf_sections: bool = False,
+):
+    """
+    Match a file or buffer with YARA rules or a LiteralEngine, returning match_hits()
+    :param dex_strings: match DEX files against their string table (see match_dex_strings)
+    :param elf_sections: match ELF files against ELF_SCAN_SECTIONS only (see match_elf_sections)
+    """
+    with contextlib.ExitStack() as stack:
+        if dex_strings or elf_sections:
+            file_data = data if data is not None else map_file(stack, path)
+            if dex_strings and file_data[:4] == DEX_MAGIC:
+                try:
+                    return match_dex_strings(rules, file_data)
+                except (IndexError, ValueError, struct.error):
+                    pass  # broken string table, scan the raw bytes instead
+            if elf_sections and file_data[:4] == ELF_MAGIC:
+                try:
+                    sections = list(read_elf_sections(file_data))
+                except (IndexError, ValueError, struct.error):
+                    sections = None  # broken section headers
+                if sections:
+                    try:
+                        return match_elf_sections(rules, sections)
+                    finally:
+                        # the views pin the mmap, it can't close while they exist
+                        for _, section in sections:
+                            section.release()
+    if isinstance(rules, LiteralEngine):
+        return rules.match(path, data)
+    matches = rules.match(data=data) if data is not None else rules.match(path)
+    return list(match_hits(matches))
+
+
+def match_entry(
+    rules,
+    z: zipfile.ZipFile,
+    info,
+    digest: bool = False,
+    dex_strings: bool = False,
+    elf_sections: bool = False,
+):
+    """
+    Match a DEX/ELF entry, in memory if it is small enough, from a temporary file otherwise
+    :param digest: also hash the entry while it is read
+    :param dex_strings, elf_sections: see match_rules()
+    :return: list of match_hits() and the entry's sha256 hex digest (None unless digest)
+    """
+    sha256 = hashlib.sha256() if digest else None
+    if info.file_size <= SCAN_MEMORY_LIMIT:
+        with z.open(info) as f:
+            data = f.read()
+        if sha256:
+            sha256.update(data)
+        hits = match_rules(rules, None, data, dex_strings, elf_sections)
+    else:
+        import tempfile
+
+        with tempfile.NamedTemporaryFile() as temp_file:
+            with z.open(info) as f:
+                while chunk := f.read(COPY_CHUNK_SIZE):
+                    temp_file.write(chunk)
+                    if sha256:
+                        sha256.update(chunk)
+            temp_file.flush()
+            hits = match_rules(rules, temp_file.name, None, dex_strings, elf_sections)
+    return hits, sha256.hexdigest() if sha256 else None
+
+
+class ScanCache:
+    """
+    On-disk (sqlite) cache of DEX/ELF match results keyed on the entry's sha256
+    and the rules fingerprint, so the same SDK .dex or .so found in many APKs is
+    only scanned once. The ZIP CRC32 and size act as a pre-key: entries whose
+    pre-key was never seen are not hashed up front. The least recently used
+    results are evicted beyond max_entries when the cache is closed.
+    """
+
+    def __init__(self, path: str, fingerprint: str, max_entries: int = SCAN_CACHE_SIZE):
+        import sqlite3
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS scan_results ("
+            "digest TEXT, fingerprint TEXT, crc INTEGER, size INTEGER, "
+            "hits TEXT, last_used REAL, PRIMARY KEY (digest, fingerprint))"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS scan_results_prekey "
+            "ON scan_results (crc, size, fingerprint)"
+        )
+        self.db.commit()
+
+    def lookup(self, z: zipfile.ZipFile, info):
+        """
+        Look up the cached hits of an entry
+        :return: (sha256 digest, hits); the digest is None when the pre-key
+                 missed and hits is None when nothing is cached
+        """
+        with self.lock:
+            seen = self.db.execute(
+                "SELECT 1 FROM scan_results "
+                "WHERE crc = ? AND size = ? AND fingerprint = ? LIMIT 1",
+                (info.CRC, info.file_size, self.fingerprint),
+            ).fetchone()
+        if not seen:
+            return None, None
+
+        sha256 = hashlib.sha256()
+        with z.open(info) as f:
+            while chunk := f.read(COPY_CHUNK_SIZE):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+
+        with self.lock:
+            row = self.db.execute(
+                "SELECT hits FROM scan_results WHERE digest = ? AND fingerprint = ?",
+                (digest, self.fingerprint),
+            ).fetchone()
+            if row:
+                self.db.execute(
+                    "UPDATE scan_results SET last_used = ? "
+                    "WHERE digest = ? AND fingerprint = ?",
+                    (time.time(), digest, self.fingerprint),
+                )
+                self.db.commit()
+        return digest, json.loads(row[0]) if row else None
+
+    def store(self, digest: str, info, hits):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO scan_results VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    digest,
+                    self.fingerprint,
+                    info.CRC,
+                    info.file_size,
+                    json.dumps(hits),
+                    time.time(),
+                ),
+            )
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM scan_results WHERE rowid IN (SELECT rowid FROM "
+                "scan_results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self.db.commit()
+            self.db.close()
+
+
+def scan_apk(
+    apk_path: str,
+    rules_path: str,
+    rules=None,
+    quiet: bool = False,
+    cache: ScanCache | None = None,
+    dex_strings: bool = False,
+    elf_sections: bool = False,
+    on_entry=None,
+    on_error=None,
+):
+    """
+    Scan APK, DEX, and ELF files (streaming, handles embedded APKs)
+    :param rules: already compiled rules, rules_path is only compiled when None
+    :param quiet: don't print scan progress (printed to stderr)
+    :param cache: DEX/ELF result cache, entries found in it skip YARA
+    :param dex_strings: match DEX files against their string table only
+    :param elf_sections: match ELF files against ELF_SCAN_SECTIONS only
+    :param on_entry: called as each entry is scanned, with the APK path, file
+                     type, entry name, hits, seconds, bytes and whether the
+                     hits came from the cache (see NdjsonWriter.entry)
+    :param on_error: called with the APK path and error when the APK, or an
+                     APK embedded in it, can't be opened (see NdjsonWriter.error)
+    """
+    import zipfile
+
+    if rules is None:
+        rules = load_rules(rules_path)
+    log = (
+        (lambda *args, **kwargs: None)
+        if quiet
+        else functools.partial(print, file=sys.stderr)
+    )
     results = {
         "apk": defaultdict(lambda: defaultdict(set)),
         "dex": defaultdict(lambda: defaultdict(lambda: defaultdict(set))),
         "elf": defaultdict(lambda: defaultdict(lambda: defaultdict(set))),
     }
 
-    def scan_file(file_data, file_name, file_type):
-        for match in rules.match(data=file_data):
-            for _, offset, data in match.strings:
-                rule_type = str(offset).replace("$", "")
-                results[file_type][file_name][match.rule][rule_type].add(
-                    data.decode("utf-8", errors="ignore")
+    def add_matches(hits, file_results):
+        for rule, rule_type, data in hits:
+            file_results[rule][rule_type].add(data)
+
+    def scan_entry(z: zipfile.ZipFile, info, file_type: str):
+        start = time.perf_counter()
+        digest, hits = cache.lookup(z, info) if cache else (None, None)
+        cached = hits is not None
+        if not cached:
+            hits, new_digest = match_entry(
+                rules,
+                z,
+                info,
+                cache is not None and digest is None,
+                dex_strings,
+                elf_sections,
+            )
+            if cache:
+                cache.store(digest or new_digest, info, hits)
+        if on_entry:
+            seconds = time.perf_counter() - start
+            size = 0 if cached else info.file_size
+            on_entry(apk_path, file_type, info.filename, hits, seconds, size, cached)
+        return hits
+
+    def scan_zip(z: zipfile.ZipFile):
+        for info in z.infolist():
+            if info.is_dir():
+                continue
+            with z.open(info) as f:
+                magic = f.read(MAGIC_SIZE)
+            if magic == DEX_MAGIC or magic == ELF_MAGIC:
+                file_type = "dex" if magic == DEX_MAGIC else "elf"
+                log(f"\rScanning {info.filename}", end="")
+                add_matches(
+                    scan_entry(z, info, file_type), results[file_type][info.filename]
                 )
+            elif magic == APK_MAGIC:
+                log(f"\rFound embedded APK: {info.filename}")
+                with contextlib.ExitStack() as stack:
+                    try:
+                        embedded = open_embedded_apk(stack, z, info)
+                    except (zipfile.BadZipFile, OSError) as e:
+                        log(f"Failed to open APK: {info.filename}: {e}")
+                        if on_error:
+                            on_error(apk_path, f"{info.filename}: {e}")
+                        continue
+                    scan_zip(embedded)
 
-    apk_queue = []
-    if isinstance(apk_path, str):
-        apk_queue.append((apk_path, None))
-    else:
-        apk_queue.append((None, apk_path))
+    try:
+        z = zipfile.ZipFile(apk_path)
+    except Exception as e:
+        log(f"Failed to open APK: {apk_path}: {e}")
+        if on_error:
+            on_error(apk_path, str(e))
+        return results
+
+    with z:
+        start = time.perf_counter()
+        hits = []
+        if isinstance(apk_path, str):
+            hits = match_rules(rules, apk_path)
+        add_matches(hits, results["apk"])
+        if on_entry and isinstance(apk_path, str):
+            seconds = time.perf_counter() - start
+            size = os.path.getsize(apk_path)
+            on_entry(apk_path, "apk", None, hits, seconds, size, False)
+        scan_zip(z)
+
+    return results
+
+
+def collect_apks(paths, list_file: str | None = None):
+    """
+    Expand APK paths, directories (searched recursively) and a list file
+    (one path per line, # comments allowed) into a list of APK paths
+    """
+    paths = list(paths)
+    if list_file:
+        with open(list_file, "r") as f:
+            paths += [
+                line.strip() for line in f if line.strip() and not line.startswith("#")
+            ]
+
+    apks = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                apks += [
+                    os.path.join(dirpath, filename)
+                    for filename in sorted(filenames)
+                    if filename.lower().endswith(APK_EXTENSIONS)
+                ]
+        else:
+            apks.append(path)
+    return apks
+
+
+def scan_apks(
+    apks,
+    rules,
+    output,
+    workers: int = 1,
+    cache: ScanCache | None = None,
+    dex_strings: bool = False,
+    elf_sections: bool = False,
+    on_entry=None,
+    on_error=None,
+):
+    """
+    Scan many APKs with a thread pool, writing one JSON line per APK to output
+    (unless it is None) as soon as it is done. The compiled rules are shared by
+    every worker: yara-python releases the GIL while matching.
+    :param on_error: called with the APK path and error of every APK that
+                     couldn't be opened or scanned (see NdjsonWriter.error)
+    """
+    import zipfile
+    from concurrent.futures import ThreadPoolExecutor, as_completed
 
-    while apk_queue:
-        current_path, current_fileobj = apk_queue.pop(0)
+    def scan_one(apk_path):
+        if not zipfile.is_zipfile(apk_path):
+            return {"apk": apk_path, "error": "not a valid APK/ZIP file"}
         try:
-            z = (
-                zipfile.ZipFile(current_path)
-                if current_path
-                else zipfile.ZipFile(current_fileobj)
+            results = scan_apk(
+                apk_path,
+                None,
+                rules,
+                True,
+                cache,
+                dex_strings,
+                elf_sections,
+                on_entry,
+                on_error,
             )
         except Exception as e:
-            print(f"Failed to open APK: {current_path or current_fileobj}: {e}")
-            continue
+            return {"apk": apk_path, "error": str(e)}
+        return {"apk": apk_path, "results": to_json(results)}
 
-        if current_path:
-            for match in rules.match(current_path):
-                for _, offset, data in match.strings:
-                    rule_type = str(offset).replace("$", "")
-                    results["apk"][match.rule][rule_type].add(
-                        data.decode("utf-8", errors="ignore")
-                    )
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(scan_one, apk_path) for apk_path in apks]
+        for done, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+            failed += "error" in record
+            if on_error and "error" in record:
+                on_error(record["apk"], record["error"])
+            if output:
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+            print(f"\r[{done}/{len(apks)}] {record['apk']}", end="", file=sys.stderr)
+    print(
+        f"\n{GREEN}Scanned {len(apks) - failed} APK(s){NC}, {failed} failed.",
+        file=sys.stderr,
+    )
 
-        for file in z.namelist():
-            with z.open(file) as f:
-                file_data = f.read()
-                if file_data.startswith(DEX_MAGIC):
-                    print(f"\rScanning {file}", end="")
-                    scan_file(file_data, file, "dex")
-                elif file_data.startswith(ELF_MAGIC):
-                    print(f"\rScanning {file}", end="")
-                    scan_file(file_data, file, "elf")
-                elif file_data.startswith(APK_MAGIC):
-                    print(f"\rFound embedded APK: {file}")
-                    embedded_apk = io.BytesIO(file_data)
-                    apk_queue.append((None, embedded_apk))
 
-    return results
+class NdjsonWriter:
+    """
+    Stream scan results as NDJSON: a "match" record for every hit as soon as
+    its entry is scanned, then one "summary" record with per-entry scan time
+    and bytes, rule hit counts and the result cache hit ratio
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.lock = threading.Lock()
+        self.entries = []
+        self.errors = 0
+        self.rule_hits = defaultdict(int)
+        self.start = time.perf_counter()
+
+    def write(self, record):
+        self.output.write(json.dumps(record) + "\n")
+        self.output.flush()
+
+    def entry(self, apk, file_type, entry, hits, seconds, size, cached):
+        """on_entry callback of scan_apk / scan_apks"""
+        with self.lock:
+            for rule, rule_type, data in sorted(hits):
+                self.rule_hits[rule] += 1
+                self.write(
+                    {
+                        "type": "match",
+                        "apk": apk,
+                        "file_type": file_type,
+                        "entry": entry,
+                        "rule": rule,
+                        "rule_type": rule_type,
+                        "match": data,
+                    }
+                )
+            self.entries.append(
+                {
+                    "apk": apk,
+                    "file_type": file_type,
+                    "entry": entry,
+                    "seconds": round(seconds, 6),
+                    "bytes": size,
+                    "cached": cached,
+                }
+            )
+
+    def error(self, apk, message):
+        """on_error callback of scan_apk / scan_apks"""
+        with self.lock:
+            self.errors += 1
+            self.write({"type": "error", "apk": apk, "error": message})
+
+    def summary(self):
+        with self.lock:
+            cache_hits = sum(entry["cached"] for entry in self.entries)
+            cacheable = sum(entry["file_type"] != "apk" for entry in self.entries)
+            self.write(
+                {
+                    "type": "summary",
+                    "apks": len({entry["apk"] for entry in self.entries}),
+                    "errors": self.errors,
+                    "seconds": round(time.perf_counter() - self.start, 6),
+                    "bytes_scanned": sum(entry["bytes"] for entry in self.entries),
+                    "rule_hits": dict(sorted(self.rule_hits.items())),
+                    "cache_hits": cache_hits,
+                    "cache_hit_ratio": (
+                        round(cache_hits / cacheable, 4) if cacheable else 0.0
+                    ),
+                    "entries": self.entries,
+                }
+            )
 
 
 def to_json(results):
@@ -241,7 +1245,12 @@ def print_matches(results):
 
 def main():
     parser = argparse.ArgumentParser(description="Exodus CLI")
-    parser.add_argument("apk", nargs="?", help="Path to APK file")
+    parser.add_argument(
+        "apk", nargs="*", help="Path to APK file(s) or directories of APKs"
+    )
+    parser.add_argument(
+        "-l", "--list", help="File with one APK path per line (batch mode)"
+    )
     parser.add_argument(
         "-r",
         "--rules",
@@ -250,7 +1259,8 @@ def main():
         const="trackers.yara",
         help="Path to YARA rules file",
     )
-    parser.add_argument(
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument(
         "-j", "--json", nargs="?", const="output.json", help="Save results to JSON file"
     )
     parser.add_argument(
@@ -260,28 +1270,172 @@ def main():
         const="default",
         help="Generate YARA rules.",
     )
+    parser.add_argument(
+        "-u",
+        "--update",
+        action="store_true",
+        help="With --gen, update an existing rules file, regenerating only changed trackers",
+    )
+    parser.add_argument(
+        "--trackers",
+        help="Read the Exodus trackers JSON from this file instead of the API "
+        "(--gen and the literal engine)",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=("yara", "literal"),
+        default="yara",
+        help="Match with the YARA rules, or with the literal (Aho-Corasick) engine "
+        "that finds the same hits and only uses YARA, if installed, for regex "
+        "signatures",
+    )
+    parser.add_argument(
+        "-d",
+        "--dex-strings",
+        action="store_true",
+        help="Match DEX files against their string table only, "
+        "reporting the whole string (e.g. class) of each hit",
+    )
+    parser.add_argument(
+        "-s",
+        "--elf-sections",
+        action="store_true",
+        help=f"Match ELF files against their {', '.join(ELF_SCAN_SECTIONS)} sections "
+        "only, reporting the section of each hit",
+    )
+    output.add_argument(
+        "-n",
+        "--ndjson",
+        nargs="?",
+        const="-",
+        help="Stream every match as an NDJSON record, followed by a summary "
+        "record, to this file (default: stdout)",
+    )
+    output.add_argument(
+        "--jsonl",
+        help="Write batch results as JSON lines to this file (default: stdout)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of APKs scanned in parallel in batch mode",
+    )
+    parser.add_argument(
+        "--install-deps",
+        action="store_true",
+        help="Install the scan dependencies (yara-python-dex, pyahocorasick) and exit",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"Don't use the compiled rules and scan results cached in {CACHE_DIR}",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=SCAN_CACHE_SIZE,
+        help="Number of DEX/ELF scan results kept in the cache",
+    )
     args = parser.parse_args()
 
+    if args.install_deps:
+        install_deps()
+        sys.exit(0)
+
     if args.gen:
-        if os.path.exists(args.rules):
+        if os.path.exists(args.rules) and not (args.update or args.trackers):
             print(
                 f"File {args.rules} already exists, please don't abuse Exodus. Exiting."
             )
             sys.exit(1)
 
-        gen_rule()
+        gen_rule(args.rules, args.trackers, args.update)
         print()
 
         print("\033c", end="") if args.apk else None
         sys.exit(0) if not args.apk else None
 
-    if not args.apk:
+    if not args.apk and not args.list:
         print(f"{RED}ERROR:{NC} The following arguments are required: apk{NC}")
         parser.print_help()
         sys.exit(1)
 
-    results = scan_apk(args.apk, args.rules)
+    batch = bool(args.list) or len(args.apk) > 1 or os.path.isdir(args.apk[0])
+    if batch and args.json:
+        print(
+            f"{RED}ERROR:{NC} --json saves a single APK, use --jsonl or --ndjson "
+            "to save a batch"
+        )
+        sys.exit(1)
+    if args.jsonl and not batch:
+        print(f"{RED}ERROR:{NC} --jsonl saves a batch, use --json for a single APK")
+        sys.exit(1)
+
+    try:
+        if args.engine == "literal":
+            trackers = load_trackers(args.rules, args.trackers)
+            if trackers is None:
+                sys.exit(1)
+            rules = LiteralEngine(trackers)
+            fingerprint = rules.fingerprint
+        else:
+            rules = load_rules(args.rules, None if args.no_cache else CACHE_DIR)
+            fingerprint = rules_fingerprint(args.rules)
+    except ImportError as e:
+        print(f"{RED}ERROR:{NC} {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.dex_strings:
+        fingerprint += "-dex-strings"
+    if args.elf_sections:
+        fingerprint += "-elf-sections"
+    cache = None
+    if not args.no_cache:
+        cache = ScanCache(
+            os.path.join(CACHE_DIR, "scan_results.sqlite"),
+            fingerprint,
+            args.cache_size,
+        )
 
+    options = args.dex_strings, args.elf_sections
+    ndjson = None
+    if args.ndjson:
+        ndjson = NdjsonWriter(
+            sys.stdout if args.ndjson == "-" else open(args.ndjson, "w")
+        )
+    on_entry = ndjson.entry if ndjson else None
+    on_error = ndjson.error if ndjson else None
+    try:
+        if batch:
+            apks = collect_apks(args.apk, args.list)
+            workers = max(1, args.workers)
+            if ndjson:
+                scan_apks(
+                    apks, rules, None, workers, cache, *options, on_entry, on_error
+                )
+            elif args.jsonl:
+                with open(args.jsonl, "w") as f:
+                    scan_apks(apks, rules, f, workers, cache, *options)
+                print(f"Results saved to {args.jsonl}", file=sys.stderr)
+            else:
+                scan_apks(apks, rules, sys.stdout, workers, cache, *options)
+            return
+
+        results = scan_apk(
+            args.apk[0], args.rules, rules, False, cache, *options, on_entry, on_error
+        )
+    finally:
+        if cache:
+            cache.close()
+        if ndjson:
+            ndjson.summary()
+            if ndjson.output is not sys.stdout:
+                ndjson.output.close()
+
+    if ndjson:
+        return
     if args.json:
         with open(args.json, "w") as f:
             json.dump(to_json(results), f, indent=2)
@@ -2,7 +2,7 @@
 # @auhtor: AbhiTheModder
 
 """
-usage: flutter_ssl_patch.py [-h] [-b BINARY] [-a {arm,arm64,x86}] [-p]
+usage: flutter_ssl_patch.py [-h] [-b BINARY] [-a {arm,arm64,x86}] [-p] [-n]
 
 Search & patch for SSL verification bypass in flutter binary.
 
@@ -13,6 +13,7 @@ options:
   -a {arm,arm64,x86}, --arch {arm,arm64,x86}
                         Binary arch
   -p, --print           Do Not Patch, Just Print Details
+  -n, --native          Scan the ELF in Python, without radare2
 
 Example(s):
 1. Outside r2-shell:
@@ -26,9 +27,18 @@ ssl_verify_peer_cert patched successfully!
 Analyzing function calls...
 Searching for offset...
 ssl_verify_peer_cert patched successfully!
+
+3. Without radare2 (matches are function starts, no analysis needed):
+~$ python3 flutter_ssl_patch.py --native --binary libflutter.so
+Searching for offset...
+ssl_verify_peer_cert found at: 0x5f2a10
+ssl_verify_peer_cert patched successfully!
 """
 
+import re
 import json
+import mmap
+import struct
 import argparse
 import importlib
 import subprocess
@@ -64,10 +74,6 @@ def import_library(library_name: str, package_name: str = None):
         return importlib.import_module(library_name)
 
 
-import_library("r2pipe")
-
-import r2pipe
-
 # https://github.com/NVISOsecurity/disable-flutter-tls-verification/blob/main/disable-flutter-tls.js#L25
 patterns = {
     "arm64": [
@@ -85,11 +91,46 @@ patterns = {
         "55 41 57 41 56 41 55 41 54 53 50 49 89 f. 4. 8b .. 4. 8b 4. 30 4c 8b .. .. 0. 00 00 4d 85 .. 74 1. 4d 8b",
         "55 41 57 41 56 41 55 41 54 53 48 83 EC 18 49 89 FF 48 8B 1F 48 8B 43 30 4C 8B A0 28 02 00 00 4D 85 E4 74",
         "55 41 57 41 56 41 55 41 54 53 48 83 EC 18 49 89 FE 4C 8B 27 49 8B 44 24 30 48 8B 98 D0 01 00 00 48 85 DB",
-        "55 89 E5 53 57 56 83 E4 F0 83 EC 20 E8 00 00 00 00 5B 81 C3 2B 79 66 00 8B 7D 08 8B 17 8B 42 18 8B 80 88 01"
+        "55 89 E5 53 57 56 83 E4 F0 83 EC 20 E8 00 00 00 00 5B 81 C3 2B 79 66 00 8B 7D 08 8B 17 8B 42 18 8B 80 88 01",
         "55 41 57 41 56 41 55 41 54 53 48 83 EC 38 C6 02 50 48 8B AF A. 00 00 00 48 85 ED 74 7. 48 83 7D 00 00 74",  # This pattern finds `session_verify_cert_chain` instead
     ],
 }
 
+# ELF e_machine values, see elf.h. The x86 patterns are x86-64 code, 32-bit x86 is not supported
+ELF_MACHINES = {183: "arm64", 40: "arm", 62: "x86", 3: "i386"}
+ELF_PT_LOAD = 1
+ELF_PF_X = 1
+
+# what `wao ret0` / `wao ret1` write at the function start
+RET_PATCHES = {
+    "arm64": (bytes.fromhex("000080D2C0035FD6"), bytes.fromhex("200080D2C0035FD6")),
+    "arm": (bytes.fromhex("00207047"), bytes.fromhex("01207047")),  # thumb
+    "x86": (bytes.fromhex("31C0C3"), bytes.fromhex("B801000000C3")),
+}
+
+# the ret stub replaces the first instructions, so a match has to be where a function starts
+FUNCTION_ALIGNMENT = {"arm64": 4, "arm": 2, "x86": 1}
+PROLOGUES = {
+    "arm64": [
+        "3F 23 03 D5",  # paciasp
+        "5F 24 03 D5",  # bti c
+        "F. .. .. D1",  # sub sp, sp, #imm
+        "F. .F .. F8",  # str xN, [sp, #-imm]!
+        "FD 7B .. A9",  # stp x29, x30, [sp, #-imm]!
+    ],
+    "arm": [
+        "2D E9",  # push.w {..., lr}
+        ".. B5",  # push {..., lr}
+    ],
+    "x86": [
+        "F3 0F 1E FA",  # endbr64
+        "55",  # push rbp
+        "53",  # push rbx
+        "41 5.",  # push r12-r15
+        "48 83 EC",  # sub rsp, imm8
+    ],
+}
+
 
 def get_r2_version():
     """
@@ -149,6 +190,147 @@ def find_offset(r2, patterns, is_iA=False, arch=None):
                 return search_fcn, patch_cmd
 
 
+def read_elf(data):
+    """
+    Reads the architecture and the executable segments of an ELF file
+    :param data: ELF bytes (or mmap)
+    :return: (arch, [(file offset, file size, virtual address), ...])
+    """
+    if data[:4] != b"\x7fELF":
+        raise ValueError("Not an ELF file")
+    is_64 = data[4] == 2
+    endian = "<" if data[5] == 1 else ">"
+    machine = struct.unpack_from(f"{endian}H", data, 18)[0]
+    if is_64:
+        (phoff,) = struct.unpack_from(f"{endian}Q", data, 32)
+        phentsize, phnum = struct.unpack_from(f"{endian}HH", data, 54)
+    else:
+        (phoff,) = struct.unpack_from(f"{endian}I", data, 28)
+        phentsize, phnum = struct.unpack_from(f"{endian}HH", data, 42)
+
+    segments = []
+    for i in range(phnum):
+        offset = phoff + i * phentsize
+        if is_64:
+            p_type, p_flags, p_offset, p_vaddr, _, p_filesz = struct.unpack_from(
+                f"{endian}IIQQQQ", data, offset
+            )
+        else:
+            p_type, p_offset, p_vaddr, _, p_filesz, _, p_flags = struct.unpack_from(
+                f"{endian}IIIIIII", data, offset
+            )
+        if p_type == ELF_PT_LOAD and p_flags & ELF_PF_X and p_filesz:
+            segments.append((p_offset, min(p_filesz, len(data) - p_offset), p_vaddr))
+    return ELF_MACHINES.get(machine), segments
+
+
+def compile_patterns(patterns):
+    """
+    Compiles masked hex patterns ("F. 0F 1C F8 .. 68") into one regex, a group per pattern
+    :param patterns: list of patterns
+    :return: compiled regex, matched pattern index is `match.lastindex - 1`
+    """
+    groups = []
+    for pattern in patterns:
+        regex = b""
+        hexpairs = "".join(pattern.split()).upper()  # like r2, spaces are optional
+        for i in range(0, len(hexpairs), 2):
+            token = hexpairs[i : i + 2]
+            if token == "..":
+                regex += b"."
+                continue
+            high, low = token
+            values = [
+                value
+                for value in range(256)
+                if high in (".", f"{value >> 4:X}") and low in (".", f"{value & 0xF:X}")
+            ]
+            if len(values) == 1:
+                regex += re.escape(bytes(values))
+            else:
+                regex += (
+                    b"["
+                    + b"".join(re.escape(bytes([value])) for value in values)
+                    + b"]"
+                )
+        groups.append(b"(" + regex + b")")
+    return re.compile(b"|".join(groups), re.DOTALL)
+
+
+def find_offset_native(data, patterns, arch=None):
+    """
+    Searches for patterns in the executable segments of the binary, without radare2
+    :param data: ELF bytes (or mmap)
+    :param patterns: dictionary of patterns
+    :return: (file offset, virtual address, patch bytes) or None
+    """
+    elf_arch, segments = read_elf(data)
+    segments = segments or [(0, len(data), 0)]
+    arch = arch or elf_arch
+    if arch not in patterns or elf_arch not in (None, arch):
+        print(f"{RED}Unsupported architecture: {elf_arch or arch}{NC}")
+        return
+
+    # one pass over the code for all patterns, the earliest pattern in the list wins like with r2
+    regex = compile_patterns(patterns[arch])
+    found = {}
+    for offset, size, vaddr in segments:
+        for match in regex.finditer(data, offset, offset + size):
+            idx = match.lastindex - 1
+            found.setdefault(idx, (match.start(), vaddr + match.start() - offset))
+            if 0 in found:
+                break
+        if 0 in found:
+            break
+    if not found:
+        return
+
+    idx = min(found)
+    file_offset, address = found[idx]
+    print(f"ssl_verify_peer_cert found at: {BLUE}{hex(address)}{NC}")
+    if not is_function_start(data, file_offset, address, arch):
+        raise ValueError(f"{hex(address)} is not a function start, not patching")
+    ret1 = (arch == "arm64" and idx == 3) or (arch == "x86" and idx == 5)
+    return file_offset, address, RET_PATCHES[arch][ret1]
+
+
+def is_function_start(data, file_offset, address, arch):
+    """
+    Checks that the code at file_offset is aligned and opens with a prologue of the arch
+    :param data: ELF bytes (or mmap)
+    :param file_offset: offset of the match in the file
+    :param address: virtual address of the match
+    :param arch: binary arch
+    :return: True if the ret stub can be written there
+    """
+    if address % FUNCTION_ALIGNMENT[arch]:
+        return False
+    return compile_patterns(PROLOGUES[arch]).match(data, file_offset) is not None
+
+
+def patch_native(binary, arch=None, print_only=False):
+    """
+    Finds and patches ssl_verify_peer_cert in place using mmap
+    :param binary: path to the binary file
+    :param arch: binary arch, read from the ELF header if None
+    :param print_only: do not patch, just print details
+    :return: True if found
+    """
+    with open(binary, "rb" if print_only else "r+b") as f:
+        access = mmap.ACCESS_READ if print_only else mmap.ACCESS_WRITE
+        with mmap.mmap(f.fileno(), 0, access=access) as data:
+            print(f"{YELLOW}Searching for offset...{NC}")
+            result = find_offset_native(data, patterns, arch)
+            if not result:
+                return False
+            file_offset, _, patch = result
+            if not print_only:
+                data[file_offset : file_offset + len(patch)] = patch
+                data.flush()
+                print(f"{GREEN}ssl_verify_peer_cert patched successfully!{NC}")
+    return True
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Search & patch for SSL verification bypass in flutter binary."
@@ -171,8 +353,30 @@ if __name__ == "__main__":
         action="store_true",
         required=False,
     )
+    parser.add_argument(
+        "-n",
+        "--native",
+        help="Scan the ELF in Python, without radare2",
+        action="store_true",
+        required=False,
+    )
     args = parser.parse_args()
 
+    if args.native:
+        if not args.binary:
+            print(f"{RED}Error: Please provide a binary file path.{NC}")
+            sys.exit(1)
+        try:
+            found = patch_native(args.binary, args.arch, args.print)
+        except (OSError, ValueError, struct.error) as e:
+            print(f"{RED}Error: {str(e)}{NC}")
+            sys.exit(1)
+        if not found:
+            print(f"{RED}ssl_verify_peer_cert not found.{NC}")
+        sys.exit(0)
+
+    r2pipe = import_library("r2pipe")
+
     if not args.arch:
         try:
             r2_version = tuple(map(int, get_r2_version().split(".")))
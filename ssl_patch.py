@@ -6,6 +6,8 @@ import os
 import re
 import subprocess
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from zipfile import BadZipFile, ZipFile
 
 RED = "\033[0;31m"
@@ -21,6 +23,13 @@ JAVAX_SEARCH_REGEX = r"(\.method public (final )?\S+\(Ljava/lang/String;Ljavax/n
 JAVAX_REPLACE_REGEX = (
     r"\1\n\t.registers 3\n\n\tconst/4 v0, 0x1\n\n\treturn v0\n.end method"
 )
+# Literals every method matched by the regexes above must contain. Files and
+# methods missing any of them are skipped without running the regex.
+OKHTTP3_ANCHORS = (
+    "Ljava/security/cert/X509Certificate;",
+    "Ljavax/net/ssl/SSLPeerUnverifiedException;",
+)
+JAVAX_ANCHORS = ("Ljavax/net/ssl/SSLSession;",)
 XML_CONTENT = """<?xml version="1.0" encoding="utf-8"?>
 <network-security-config>
     <base-config cleartextTrafficPermitted="true">
@@ -52,26 +61,103 @@ def merge_apks(file_path: str) -> str | None:
         return None
 
 
+def iter_method_spans(file_content: str):
+    """Yield (start, end) offsets of every `.method ... .end method` block."""
+    start = file_content.find(".method ")
+    while start != -1:
+        end = file_content.find(".end method", start)
+        if end == -1:
+            return
+        end += len(".end method")
+        yield start, end
+        start = file_content.find(".method ", end)
+
+
+def apply_regex_to_file(
+    file_path: str,
+    pattern: re.Pattern,
+    replace_pattern: str,
+    anchors: tuple[str, ...] = (),
+) -> bool:
+    """Apply a compiled regex patch to one smali file. Returns True if the file changed.
+
+    With anchors, the file is skipped unless it contains all of them, and the
+    regex only runs on the method bodies that do.
+    """
+    with open(file_path, "rb") as file:
+        data = file.read()
+
+    if not all(anchor.encode() in data for anchor in anchors):
+        return False
+
+    file_content = data.decode()
+    if anchors:
+        parts = []
+        last = 0
+        for start, end in iter_method_spans(file_content):
+            method = file_content[start:end]
+            if all(anchor in method for anchor in anchors):
+                parts.append(file_content[last:start])
+                parts.append(pattern.sub(replace_pattern, method))
+                last = end
+        parts.append(file_content[last:])
+        new_content = "".join(parts)
+    else:
+        new_content = pattern.sub(replace_pattern, file_content)
+
+    if new_content != file_content:
+        with open(file_path, "wb") as file:
+            file.write(new_content.encode())
+        return True
+    return False
+
+
 # https://github.com/AbhiTheModder/termux-scripts/blob/1e90d618bc9725798c96ca1313d79a71e31b5dcb/tgpatcher.py#L240
-def apply_regex(root_directory: str, search_pattern: str, replace_pattern: str):
-    """Apply a regex search and replace patch across all smali files in the root directory."""
+def apply_regex(
+    root_directory: str,
+    search_pattern: str,
+    replace_pattern: str,
+    jobs: int = 1,
+    anchors: tuple[str, ...] = (),
+):
+    """Apply a regex search and replace patch across all smali files in the root directory.
+
+    With jobs > 1 the files are sharded across a process pool. See
+    apply_regex_to_file() for anchors.
+    """
     pattern = re.compile(search_pattern)
 
     print(f"INFO: Applying regex patch to {root_directory}")
 
-    for dirpath, _, filenames in os.walk(root_directory):
-        for filename in filenames:
-            if filename.endswith(".smali"):
-                file_path = os.path.join(dirpath, filename)
-                with open(file_path, "r") as file:
-                    file_content = file.read()
+    files = [
+        os.path.join(dirpath, filename)
+        for dirpath, _, filenames in os.walk(root_directory)
+        for filename in filenames
+        if filename.endswith(".smali")
+    ]
+    patch_file = partial(
+        apply_regex_to_file,
+        pattern=pattern,
+        replace_pattern=replace_pattern,
+        anchors=anchors,
+    )
 
-                new_content = pattern.sub(replace_pattern, file_content)
+    results = None
+    if jobs > 1 and len(files) > 1:
+        try:
+            executor = ProcessPoolExecutor(max_workers=jobs)
+        except (ImportError, NotImplementedError, OSError) as e:
+            print(f"{YELLOW}WARN: {NC}No worker processes ({e}), patching serially.")
+        else:
+            with executor:
+                chunksize = max(1, len(files) // (jobs * 16))
+                results = list(executor.map(patch_file, files, chunksize=chunksize))
+    if results is None:
+        results = map(patch_file, files)
 
-                if new_content != file_content:
-                    with open(file_path, "w") as file:
-                        file.write(new_content)
-                    print(f"INFO: Applied regex patch to {file_path}")
+    for file_path, changed in zip(files, results):
+        if changed:
+            print(f"INFO: Applied regex patch to {file_path}")
 
 
 def decompile_apk(temp_dir: str, file_path: str, okhttp: bool) -> None:
@@ -300,7 +386,7 @@ def modify_manifest(manifest_path: str) -> str:
     return nsc
 
 
-def modify_apk(temp_dir: str, okhttp: bool) -> None:
+def modify_apk(temp_dir: str, okhttp: bool, jobs: int = 1) -> None:
     lib_dirs = [
         f"{temp_dir}/out/root/lib/armeabi-v7a",
         f"{temp_dir}/out/root/lib/arm64-v8a",
@@ -309,10 +395,18 @@ def modify_apk(temp_dir: str, okhttp: bool) -> None:
     try:
         if okhttp:
             apply_regex(
-                f"{temp_dir}/out/smali", OKHTTP3_SEARCH_REGEX, OKHTTP3_REPLACE_REGEX
+                f"{temp_dir}/out/smali",
+                OKHTTP3_SEARCH_REGEX,
+                OKHTTP3_REPLACE_REGEX,
+                jobs,
+                OKHTTP3_ANCHORS,
             )
             apply_regex(
-                f"{temp_dir}/out/smali", JAVAX_SEARCH_REGEX, JAVAX_REPLACE_REGEX
+                f"{temp_dir}/out/smali",
+                JAVAX_SEARCH_REGEX,
+                JAVAX_REPLACE_REGEX,
+                jobs,
+                JAVAX_ANCHORS,
             )
         nsc = modify_manifest(f"{temp_dir}/out/AndroidManifest.xml")
         os.makedirs(temp_dir, exist_ok=True)
@@ -341,7 +435,7 @@ def modify_apk(temp_dir: str, okhttp: bool) -> None:
         raise RuntimeError(f"Error modifying APK: {str(e)}")
 
 
-def patch_apk(apk_path: str, okhttp: bool) -> None:
+def patch_apk(apk_path: str, okhttp: bool, jobs: int = 1) -> None:
     file_name = os.path.basename(apk_path) + "_ssl_patched.apk"
     with tempfile.TemporaryDirectory() as temp_dir:
         print(f"{GREEN}Decompiling APK...{NC}")
@@ -350,7 +444,7 @@ def patch_apk(apk_path: str, okhttp: bool) -> None:
             print(f"{RED}ERROR: {NC}Failed to decompile APK.")
             exit(1)
         print(f"{GREEN}Modifying APK...{NC}")
-        modify_apk(temp_dir, okhttp)
+        modify_apk(temp_dir, okhttp, jobs)
 
         print(f"{GREEN}Recompiling APK...{NC}")
         recompile_apk(temp_dir, file_name)
@@ -370,9 +464,18 @@ if __name__ == "__main__":
     parser.add_argument(
         "--okhttp", help="Patch OkHttp3", action="store_true", required=False
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of worker processes for smali patching",
+        type=int,
+        default=1,
+        required=False,
+    )
     args = parser.parse_args()
     apk_path = args.apk_path
     okhttp = args.okhttp
+    jobs = max(1, args.jobs)
 
     if not os.path.exists(APKEDITOR_PATH):
         print(
@@ -394,4 +497,4 @@ if __name__ == "__main__":
         except BadZipFile:
             print(f"{RED}ERROR: {NC}Invalid APKS file: {apk_path}")
             exit(1)
-    patch_apk(apk_path, okhttp)
+    patch_apk(apk_path, okhttp, jobs)
@@ -0,0 +1,70 @@
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cocos2d  # noqa: E402
+
+KEY = "k3yK3yk3y"
+SCRIPT = b'cc.log("hello");\n'
+
+
+@pytest.fixture
+def game_apk(tmp_path):
+    """An APK with one gzipped and encrypted script, as cocos2d-x ships them"""
+    apk_path = str(tmp_path / "game.apk")
+    with zipfile.ZipFile(apk_path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("AndroidManifest.xml", b"\0" * 64)
+        z.writestr(
+            "assets/src/main.jsc",
+            cocos2d.xxtea_encrypt(cocos2d.gzip(SCRIPT), KEY),
+        )
+    return apk_path
+
+
+def test_repack_needs_manifest(game_apk, tmp_path):
+    tree = str(tmp_path / "tree")
+    cocos2d.decrypt_apk(game_apk, tree, KEY, unzip=False)
+    os.remove(os.path.join(tree, cocos2d.MANIFEST_NAME))
+    output = str(tmp_path / "out.apk")
+    with pytest.raises(cocos2d.Cocos2dError, match="--no-manifest"):
+        cocos2d.repack_apk(game_apk, tree, KEY, output)
+    assert not os.path.exists(output)
+
+    # the tree still holds gzip data, so it must not be gzipped again
+    script_path = os.path.join(tree, "assets/src/main.js")
+    with open(script_path, "ab") as file:
+        file.write(b"// edited\n")
+    with open(script_path, "rb") as file:
+        edited = file.read()
+    summary = cocos2d.repack_apk(game_apk, tree, KEY, output, unzip=False)
+    assert summary == {"encrypted": 1, "copied": 1}
+    with zipfile.ZipFile(output) as z:
+        data, _ = cocos2d.decrypt_script(z.read("assets/src/main.jsc"), KEY, False)
+    assert data == edited
+
+
+def test_decrypt_apk_removes_partial_output(game_apk, tmp_path, monkeypatch):
+    def interrupted(*args):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(cocos2d, "decrypt_script", interrupted)
+    for output in ("out.zip", "out"):
+        output = str(tmp_path / output)
+        with pytest.raises(KeyboardInterrupt):
+            cocos2d.decrypt_apk(game_apk, output, KEY)
+        assert not os.path.exists(output)
+
+
+def test_find_key_recovers_key_from_library():
+    samples = [
+        cocos2d.xxtea_encrypt(cocos2d.gzip(SCRIPT), KEY),
+        cocos2d.xxtea_encrypt(SCRIPT * 4, KEY),
+    ]
+    decoys = [f"decoy{i}".encode() for i in range(2000)]
+    lib_data = b"\0".join([b"", *decoys, b"xxtea", KEY.encode(), b""])
+    assert cocos2d.find_key(lib_data, samples) == KEY
+    assert cocos2d.find_key(lib_data, samples, jobs=2) == KEY
@@ -0,0 +1,92 @@
+import os
+import struct
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DexRepair  # noqa: E402
+
+# a 2160 byte DEX: 0x70 byte header (file_size set) and 8 * bytes(range(256))
+DEX_BODY = bytes(range(256)) * 8
+DEX_SIGNATURE = "546916cd8153b12c236c42581719b261f1cf8edc"
+DEX_CHECKSUM = 0x7DC6059C
+
+
+def broken_dex():
+    """The known DEX with a bad magic and zeroed checksum and signature"""
+    header = b"dex\n000\0" + bytes(24) + struct.pack("<I", 0x70 + len(DEX_BODY))
+    return header + bytes(0x70 - len(header)) + DEX_BODY
+
+
+def write_aligned(z, name, data, compress_type):
+    """Add an entry the way zipalign leaves it, stored data on a 4 byte boundary"""
+    info = zipfile.ZipInfo(name)
+    info.compress_type = compress_type
+    if compress_type == zipfile.ZIP_STORED:
+        data_offset = z.fp.tell() + 30 + len(name.encode())
+        info.extra = b"\0" * (-data_offset % 4)
+    z.writestr(info, data)
+
+
+ENTRIES = [
+    ("AndroidManifest.xml", b"<manifest/>" * 20, zipfile.ZIP_DEFLATED),
+    ("classes.dex", None, zipfile.ZIP_DEFLATED),
+    ("res/raw/a.bin", b"\x01\x02\x03", zipfile.ZIP_STORED),
+    ("classes2.dex", None, zipfile.ZIP_STORED),
+    ("assets/odd.txt", b"stored after a re-written entry", zipfile.ZIP_STORED),
+]
+
+
+@pytest.fixture
+def apk_path(tmp_path):
+    path = str(tmp_path / "app.apk")
+    with zipfile.ZipFile(path, "w") as z:
+        for name, data, compress_type in ENTRIES:
+            write_aligned(
+                z, name, broken_dex() if data is None else data, compress_type
+            )
+    return path
+
+
+def data_offset(path, info):
+    with open(path, "rb") as file:
+        file.seek(info.header_offset)
+        header = file.read(30)
+    name_length, extra_length = struct.unpack_from("<HH", header, 26)
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def test_repair_apk_round_trip(apk_path, tmp_path):
+    output = str(tmp_path / "out.apk")
+    results = DexRepair.repair_apk(apk_path, True, output)
+    assert [result["path"] for result in results] == [
+        f"{apk_path}!classes.dex",
+        f"{apk_path}!classes2.dex",
+    ]
+
+    with zipfile.ZipFile(output) as z:
+        assert z.testzip() is None  # every CRC-32 matches its data
+        infos = z.infolist()
+        assert [info.filename for info in infos] == [name for name, _, _ in ENTRIES]
+        for info, (name, data, compress_type) in zip(infos, ENTRIES):
+            assert info.compress_type == compress_type
+            if compress_type == zipfile.ZIP_STORED:
+                assert data_offset(output, info) % 4 == 0, name
+            if data is not None:
+                assert z.read(info) == data
+                continue
+            dex = z.read(info)
+            assert dex[:8] == b"dex\n035\0"
+            assert struct.unpack_from("<I", dex, 8)[0] == DEX_CHECKSUM
+            assert dex[12:32].hex() == DEX_SIGNATURE
+            assert dex[32:] == broken_dex()[32:]
+
+
+def test_repair_apk_keeps_input(apk_path):
+    with pytest.raises(DexRepair.DexRepairError, match="must differ"):
+        DexRepair.repair_apk(apk_path, output_apk_path=apk_path)
+    with zipfile.ZipFile(apk_path) as z:
+        assert z.read("classes.dex") == broken_dex()
@@ -0,0 +1,201 @@
+import io
+import json
+import os
+import struct
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exodus  # noqa: E402
+
+TRACKERS = {"1": {"name": "Zlib", "code_signature": "", "network_signature": "gzopen"}}
+
+
+def build_elf(size):
+    """ELF64 with a .dynstr holding "gzopen", padded to size bytes"""
+    dynstr = b"\0gzopen\0inflate\0"
+    shstrtab = b"\0.dynstr\0.shstrtab\0"
+    dynstr_offset = 0x40
+    shstrtab_offset = dynstr_offset + len(dynstr)
+    shoff = (shstrtab_offset + len(shstrtab) + 7) & ~7
+    section_header = struct.Struct("<IIQQQQIIQQ")
+    header = b"\x7fELF\x02\x01\x01" + b"\0" * 9
+    header += struct.pack(
+        "<HHIQQQIHHHHHH", 3, 62, 1, 0, 0, shoff, 0, 0x40, 0, 0, 64, 3, 2
+    )
+    data = bytearray(header)
+    data += dynstr + shstrtab
+    data += b"\0" * (shoff - len(data))
+    data += section_header.pack(0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    data += section_header.pack(1, 3, 2, 0, dynstr_offset, len(dynstr), 0, 0, 1, 0)
+    data += section_header.pack(9, 3, 0, 0, shstrtab_offset, len(shstrtab), 0, 0, 1, 0)
+    data += b"\0" * (size - len(data))
+    return bytes(data)
+
+
+@pytest.fixture
+def big_elf_apk(tmp_path, monkeypatch):
+    """An APK whose native library is over SCAN_MEMORY_LIMIT, so it is scanned from an mmap"""
+    monkeypatch.setattr(exodus, "SCAN_MEMORY_LIMIT", 4096)
+    apk_path = tmp_path / "app.apk"
+    with zipfile.ZipFile(apk_path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("lib/x86_64/libz.so", build_elf(64 * 1024))
+    return str(apk_path)
+
+
+@pytest.mark.parametrize("accelerated", [True, False])
+def test_elf_sections_over_memory_limit_literal(big_elf_apk, monkeypatch, accelerated):
+    if accelerated and not exodus.load_ahocorasick():
+        pytest.skip("pyahocorasick is not installed")
+    if not accelerated:
+        monkeypatch.setattr(exodus, "ahocorasick", False)
+    engine = exodus.LiteralEngine(TRACKERS)
+    results = exodus.scan_apk(big_elf_apk, None, engine, quiet=True, elf_sections=True)
+    hits = exodus.to_json(results)["elf"]["lib/x86_64/libz.so"]
+    assert hits == {"zlib": {"network_signature": ["gzopen [.dynstr]"]}}
+
+
+def test_elf_sections_over_memory_limit_yara(big_elf_apk):
+    yara = pytest.importorskip("yara")
+    rules = yara.compile(
+        source='rule zlib { strings: $network_signature = "gzopen" condition: any of them }'
+    )
+    results = exodus.scan_apk(big_elf_apk, None, rules, quiet=True, elf_sections=True)
+    hits = exodus.to_json(results)["elf"]["lib/x86_64/libz.so"]
+    assert hits == {"zlib": {"network_signature": ["gzopen [.dynstr]"]}}
+
+
+def test_ndjson_batch_reports_unreadable_apk(big_elf_apk, tmp_path):
+    bad_apk = tmp_path / "bad.apk"
+    bad_apk.write_bytes(b"not a zip")
+    output = io.StringIO()
+    writer = exodus.NdjsonWriter(output)
+    engine = exodus.LiteralEngine(TRACKERS)
+    exodus.scan_apks(
+        [big_elf_apk, str(bad_apk)],
+        engine,
+        None,
+        on_entry=writer.entry,
+        on_error=writer.error,
+    )
+    writer.summary()
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    errors = [record for record in records if record["type"] == "error"]
+    assert errors == [
+        {"type": "error", "apk": str(bad_apk), "error": "not a valid APK/ZIP file"}
+    ]
+    assert records[-1]["type"] == "summary" and records[-1]["errors"] == 1
+
+
+@pytest.mark.parametrize("accelerated", [True, False])
+def test_literal_shared_by_trackers(tmp_path, monkeypatch, accelerated):
+    if accelerated and not exodus.load_ahocorasick():
+        pytest.skip("pyahocorasick is not installed")
+    if not accelerated:
+        monkeypatch.setattr(exodus, "ahocorasick", False)
+    trackers = {
+        "1": {"name": "Foo", "code_signature": "okhttp", "network_signature": ""},
+        "2": {"name": "Bar", "code_signature": "com.bar.sdk", "network_signature": ""},
+        "3": {"name": "Baz", "code_signature": "com.bar.sdk", "network_signature": ""},
+    }
+    engine = exodus.LiteralEngine(trackers)
+    hits = engine.match(data=b"Lokhttp3/Call; Lcom/bar/sdk/Init; com.bar.sdk.Init")
+    assert sorted(hits) == [
+        ("bar", "code_signature", "com.bar.sdk"),
+        ("bar", "code_signature2", "com/bar/sdk"),
+        ("baz", "code_signature", "com.bar.sdk"),
+        ("baz", "code_signature2", "com/bar/sdk"),
+        ("foo", "code_signature", "okhttp"),
+        ("foo", "code_signature2", "okhttp"),
+    ]
+
+
+PARITY_TRACKERS = {
+    "1": {
+        "name": "Firebase",
+        "code_signature": "com.google.firebase.analytics.",
+        "network_signature": "firebase.com",
+    },
+    "2": {
+        "name": "AppsFlyer",
+        "code_signature": "com.appsflyer.",
+        "network_signature": "(app|t)\\.appsflyer\\.com",
+    },
+    "3": {"name": "Zlib", "code_signature": "", "network_signature": "gzopen"},
+}
+
+
+@pytest.fixture
+def parity_apk(tmp_path):
+    """Hits for plain, wildcard and regex signatures at APK, DEX and ELF level"""
+    apk_path = tmp_path / "app.apk"
+    dex = b"dex\n035\0" + b"\0" * 0x68
+    dex += b"Lcom/google/firebase/analytics/Foo;\0https://t.appsflyer.com\0"
+    with zipfile.ZipFile(apk_path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("classes.dex", dex)
+        z.writestr("lib/x86_64/libz.so", build_elf(4096))
+        z.writestr("com/appsflyer/internal/a.properties", "host=firebase-com")
+        z.writestr(
+            zipfile.ZipInfo("assets/hosts.txt"),
+            b"app.appsflyer.com firebase.com firebaseXcom firebase\ncom",
+        )
+    return str(apk_path)
+
+
+@pytest.mark.parametrize("backend", ["accelerated", "python", "re"])
+def test_literal_engine_matches_yara(parity_apk, monkeypatch, backend):
+    yara = pytest.importorskip("yara")
+    rules = yara.compile(
+        source="".join(
+            exodus.tracker_rule(info)[1] for info in PARITY_TRACKERS.values()
+        )
+    )
+    expected = exodus.to_json(exodus.scan_apk(parity_apk, None, rules, quiet=True))
+    if backend == "accelerated" and not exodus.load_ahocorasick():
+        pytest.skip("pyahocorasick is not installed")
+    if backend != "accelerated":
+        monkeypatch.setattr(exodus, "ahocorasick", False)
+    if backend == "re":
+        monkeypatch.setattr(exodus, "yara", None)
+        monkeypatch.setitem(sys.modules, "yara", None)
+    engine = exodus.LiteralEngine(PARITY_TRACKERS)
+    results = exodus.to_json(exodus.scan_apk(parity_apk, None, engine, quiet=True))
+    assert results == expected
+    assert expected["apk"]["firebase"]["network_signature"] == [
+        "firebase.com",
+        "firebaseXcom",
+    ]
+    assert expected["apk"]["appsflyer"]["network_signature"] == ["app.appsflyer.com"]
+    assert expected["dex"]["classes.dex"]["appsflyer"] == {
+        "network_signature": ["t.appsflyer.com"]
+    }
+
+
+def run_main(monkeypatch, tmp_path, *args):
+    trackers = tmp_path / "trackers.json"
+    trackers.write_text(json.dumps({"trackers": TRACKERS}))
+    argv = ["exodus.py", "-e", "literal", "--trackers", str(trackers), "--no-cache"]
+    monkeypatch.setattr(sys, "argv", [*argv, *args])
+    exodus.main()
+
+
+def test_ndjson_single_apk_reports_unreadable_apk(tmp_path, monkeypatch):
+    bad_apk = tmp_path / "bad.apk"
+    bad_apk.write_bytes(b"not a zip")
+    output = tmp_path / "out.ndjson"
+    run_main(monkeypatch, tmp_path, str(bad_apk), "--ndjson", str(output))
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [record["type"] for record in records] == ["error", "summary"]
+    assert records[0]["apk"] == str(bad_apk)
+    assert records[1]["errors"] == 1
+
+
+def test_json_rejected_in_batch_mode(big_elf_apk, tmp_path, monkeypatch, capsys):
+    output = tmp_path / "out.json"
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, tmp_path, big_elf_apk, big_elf_apk, "-j", str(output))
+    assert "--json saves a single APK" in capsys.readouterr().out
+    assert not output.exists()
@@ -0,0 +1,116 @@
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flutter_ssl_patch  # noqa: E402
+
+# arch: (EI_CLASS, e_machine)
+ELF_TYPES = {"arm64": (2, 183), "arm": (1, 40), "x86": (2, 62), "i386": (1, 3)}
+CODE_OFFSET = 0x200
+CODE_ADDRESS = 0x5000
+MATCH_OFFSET = 0x10
+
+
+def pattern_bytes(pattern):
+    """Bytes matching a masked hex pattern, wildcards read as zero"""
+    return bytes.fromhex("".join(pattern.split()).replace(".", "0"))
+
+
+def write_elf(path, arch, code):
+    """A little-endian ELF with a data segment before one executable segment"""
+    elf_class, machine = ELF_TYPES[arch]
+    is_64 = elf_class == 2
+    phoff = 64 if is_64 else 52
+    # the first pattern in the data segment too, only the code segment is searched
+    decoy = pattern_bytes(flutter_ssl_patch.patterns.get(arch, ["90"])[0])
+    segments = [
+        (0x100, len(decoy), 0x1000, 4),
+        (CODE_OFFSET, len(code), CODE_ADDRESS, 5),
+    ]
+    data = bytearray(CODE_OFFSET + len(code))
+    data[:6] = b"\x7fELF" + bytes([elf_class, 1])
+    struct.pack_into("<H", data, 18, machine)
+    if is_64:
+        struct.pack_into("<Q", data, 32, phoff)
+        struct.pack_into("<HH", data, 54, 56, len(segments))
+    else:
+        struct.pack_into("<I", data, 28, phoff)
+        struct.pack_into("<HH", data, 42, 32, len(segments))
+    for i, (offset, size, address, flags) in enumerate(segments):
+        if is_64:
+            struct.pack_into(
+                "<IIQQQQ", data, phoff + i * 56, 1, flags, offset, address, 0, size
+            )
+        else:
+            struct.pack_into(
+                "<IIIIIII",
+                data,
+                phoff + i * 32,
+                1,
+                offset,
+                address,
+                0,
+                size,
+                size,
+                flags,
+            )
+    data[0x100 : 0x100 + len(decoy)] = decoy
+    data[CODE_OFFSET:] = code
+    with open(path, "wb") as file:
+        file.write(data)
+    return bytes(data)
+
+
+@pytest.mark.parametrize(
+    "arch, idx, ret1",
+    [
+        ("arm64", 0, False),
+        ("arm64", 3, True),
+        ("arm", 0, False),
+        ("x86", 2, False),
+        ("x86", 5, True),
+    ],
+)
+def test_patch_native(tmp_path, capsys, arch, idx, ret1):
+    match = pattern_bytes(flutter_ssl_patch.patterns[arch][idx])
+    code = b"\0" * MATCH_OFFSET + match + b"\0" * 16
+    binary = str(tmp_path / "libflutter.so")
+    original = write_elf(binary, arch, code)
+
+    assert flutter_ssl_patch.patch_native(binary)
+    assert f"found at: {flutter_ssl_patch.BLUE}{hex(CODE_ADDRESS + MATCH_OFFSET)}" in (
+        capsys.readouterr().out
+    )
+    with open(binary, "rb") as file:
+        patched = file.read()
+    stub = flutter_ssl_patch.RET_PATCHES[arch][ret1]
+    start = CODE_OFFSET + MATCH_OFFSET
+    assert patched[start : start + len(stub)] == stub
+    assert patched[:start] == original[:start]
+    assert patched[start + len(stub) :] == original[start + len(stub) :]
+
+
+def test_patch_native_rejects_i386(tmp_path, capsys):
+    match = pattern_bytes(flutter_ssl_patch.patterns["x86"][0])
+    binary = str(tmp_path / "libflutter.so")
+    original = write_elf(binary, "i386", match)
+    for arch in (None, "x86"):
+        assert not flutter_ssl_patch.patch_native(binary, arch)
+        assert "Unsupported architecture: i386" in capsys.readouterr().out
+    with open(binary, "rb") as file:
+        assert file.read() == original
+
+
+def test_patch_native_needs_function_start(tmp_path, monkeypatch):
+    # a pattern matching the middle of a function must not get a ret stub
+    monkeypatch.setitem(flutter_ssl_patch.patterns, "arm64", ["68 1A 40 F9"])
+    binary = str(tmp_path / "libflutter.so")
+    original = write_elf(binary, "arm64", bytes.fromhex("681A40F9") * 4)
+    with pytest.raises(ValueError, match="not a function start"):
+        flutter_ssl_patch.patch_native(binary)
+    with open(binary, "rb") as file:
+        assert file.read() == original
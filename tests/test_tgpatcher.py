@@ -0,0 +1,91 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tgpatcher  # noqa: E402
+
+USER_CONFIG = "T/smali/classes/org/telegram/messenger/UserConfig.smali"
+USER_CONFIG_SMALI = """.class public Lorg/telegram/messenger/UserConfig;
+.super Ljava/lang/Object;
+
+.method public isPremium()Z
+    .locals 1
+    const/4 v0, 0x0
+    return v0
+.end method
+"""
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    """A decompiled tree holding only UserConfig.smali, as the working directory"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.dirname(USER_CONFIG))
+    with open(USER_CONFIG, "w") as file:
+        file.write(USER_CONFIG_SMALI)
+    return tmp_path
+
+
+def read(file_path):
+    with open(file_path) as file:
+        return file.read()
+
+
+def test_cache_restores_unchanged_files(tree, capsys):
+    tgpatcher.main("2", "T", cache_dir="C")
+    patched = read(USER_CONFIG)
+    assert "const/4 v0, 0x1" in patched
+    assert "modified successfully" in capsys.readouterr().out
+
+    with open(USER_CONFIG, "w") as file:  # a new decompile of the same source
+        file.write(USER_CONFIG_SMALI)
+    tgpatcher.main("2", "T", cache_dir="C")
+    out = capsys.readouterr().out
+    assert read(USER_CONFIG) == patched
+    assert "modified successfully" not in out
+    assert "Restored 1 unchanged files from the cache." in out
+
+
+def test_cached_class_only_finds_declared_methods(tree):
+    cached = tgpatcher.CachedSmaliClass(USER_CONFIG)
+    assert cached.get_method("public isPremium()Z")
+    assert cached.get_method("public isPremium(J)Z") is None
+    assert not cached.edit_method("private isPremium(J)Z", list)
+    assert cached.copy_method("public isPremium()Z", "public isPremium2()Z")
+    assert cached.get_method("public isPremium2()Z")
+
+
+def test_regex_batch_applies_rules_before_later_reads(tree, capsys):
+    with tgpatcher.regex_batch():
+        tgpatcher.apply_regex("T", r"\.locals 1", ".locals 2")
+        tgpatcher.apply_regex("T", "const/4 v0, 0x0", "const/4 v0, 0x2")
+        # a method patch reading the file sees both queued rules, applied together
+        method = tgpatcher.load_smali_class(USER_CONFIG).get_method(
+            "public isPremium()Z"
+        )
+        assert method.lines[1:3] == ["    .locals 2\n", "    const/4 v0, 0x2\n"]
+    assert "Applying 2 batched regex rules" in capsys.readouterr().out
+    tgpatcher.commit_patch_plan()
+    assert "const/4 v0, 0x2" in read(USER_CONFIG)
+
+
+def test_patch_plan_reports_conflicting_lines(tree, capsys):
+    plan = tgpatcher.PatchPlan()
+    plan.write(USER_CONFIG, USER_CONFIG_SMALI.replace("0x0", "0x1"), patch="A")
+    # another line of the same method, no conflict
+    locals_2 = USER_CONFIG_SMALI.replace("0x0", "0x1").replace(".locals 1", ".locals 2")
+    plan.write(USER_CONFIG, locals_2, patch="B")
+    assert plan.conflicts == []
+
+    plan.write(USER_CONFIG, locals_2.replace("0x1", "0x2"), patch="C")
+    [(file_path, block, owner, patch)] = plan.conflicts
+    assert (file_path, owner, patch) == (USER_CONFIG, "A", "C")
+    assert "isPremium()Z" in block
+    assert read(USER_CONFIG) == USER_CONFIG_SMALI  # nothing written before commit()
+
+    plan.commit()
+    assert "CONFLICT: " in capsys.readouterr().out
+    assert read(USER_CONFIG) == locals_2.replace("0x1", "0x2")
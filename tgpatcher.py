@@ -7,9 +7,15 @@
 
 
 import argparse
+import contextlib
+import difflib
+import hashlib
+import json
 import os
 import re
+import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 RED = "\033[0;31m"
 GREEN = "\033[0;32m"
@@ -17,6 +23,8 @@ YELLOW = "\033[1;33m"
 BLUE = "\033[0;34m"
 NC = "\033[0m"  # No Color
 
+JOBS = 1  # Worker processes for the regex patches, see --jobs
+
 HOOK_SMALI = """
 .class public Lorg/telegram/abhi/Hook;
 .super Ljava/lang/Object;
@@ -102,54 +110,570 @@ class NoMethodFoundError(Exception):
     pass
 
 
+METHOD_BLOCK_PATTERN = re.compile(
+    r"^[ \t]*\.method (.*?)[ \t]*$.*?^[ \t]*\.end method[ \t]*$", re.M | re.S
+)
+
+
+def split_smali_blocks(file_content):
+    """Split smali source into {method signature: text}.
+
+    Key None holds the content outside methods, ignoring blank gaps.
+    """
+    blocks = {}
+    other = []
+    last = 0
+    for match in METHOD_BLOCK_PATTERN.finditer(file_content):
+        if file_content[last : match.start()].strip():
+            other.append(file_content[last : match.start()])
+        blocks[match.group(1)] = match.group(0)
+        last = match.end()
+    other.append(file_content[last:])
+    blocks[None] = "".join(other)
+    return blocks
+
+
+class PlannedFile:
+    """The pending state of one file in a PatchPlan."""
+
+    def __init__(self, file_path, original):
+        self.file_path = file_path
+        self.original = original
+        self.text = original
+        self.original_blocks = split_smali_blocks(original or "")
+        self.blocks = self.original_blocks
+        self.line_owners = {}  # block -> patch that last changed each of its lines
+        self.edits = []  # (patch, changed blocks)
+
+    def block_diffs(self):
+        """Yield (block, unified diff lines) for every block changed since the original."""
+        for block in dict.fromkeys([*self.original_blocks, *self.blocks]):
+            before = self.original_blocks.get(block, "")
+            after = self.blocks.get(block, "")
+            if before == after:
+                continue
+            name = block or "<class body>"
+            yield block, list(
+                difflib.unified_diff(
+                    before.splitlines(keepends=True),
+                    after.splitlines(keepends=True),
+                    f"{self.file_path}: {name} (original)",
+                    f"{self.file_path}: {name} (patched)",
+                )
+            )
+
+
+class PatchPlan:
+    """Collects the edits of the selected patches, grouped by file.
+
+    Patches read and write files through the plan; nothing touches the disk
+    until commit(), which writes every changed file once. Every line of a
+    method (or of the content outside methods) remembers the patch that
+    last wrote it; a patch changing or deleting lines written by another
+    patch is reported as a conflict.
+    """
+
+    def __init__(self):
+        self.current_patch = None
+        self.files = {}
+        self.conflicts = []
+
+    def read(self, file_path):
+        """Return the pending contents of file_path (from disk if not edited yet)."""
+        planned = self.files.get(os.path.abspath(file_path))
+        if planned is not None:
+            return planned.text
+        with open(file_path, "r") as file:
+            return file.read()
+
+    def is_planned(self, file_path):
+        return os.path.abspath(file_path) in self.files
+
+    def write(self, file_path, file_content, patch=None):
+        """Record new contents for file_path on behalf of a patch."""
+        patch = patch or self.current_patch or "-"
+        key = os.path.abspath(file_path)
+        planned = self.files.get(key)
+        if planned is None:
+            original = None
+            if os.path.exists(file_path):
+                with open(file_path, "r") as file:
+                    original = file.read()
+            planned = self.files[key] = PlannedFile(file_path, original)
+        if file_content == planned.text:
+            return
+
+        blocks = split_smali_blocks(file_content)
+        changed = [
+            block
+            for block in dict.fromkeys([*planned.blocks, *blocks])
+            if planned.blocks.get(block) != blocks.get(block)
+        ]
+        for block in changed:
+            self._track_lines(planned, block, blocks.get(block, ""), patch)
+        planned.edits.append((patch, changed))
+        planned.text = file_content
+        planned.blocks = blocks
+
+    def _track_lines(self, planned, block, new_text, patch):
+        """Attribute the lines of a changed block, reporting overlaps with other patches."""
+        old_lines = planned.blocks.get(block, "").splitlines(keepends=True)
+        new_lines = new_text.splitlines(keepends=True)
+        old_owners = planned.line_owners.get(block, [None] * len(old_lines))
+        new_owners = []
+        others = set()
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                new_owners.extend(old_owners[i1:i2])
+                continue
+            others.update(
+                owner for owner in old_owners[i1:i2] if owner not in (None, patch)
+            )
+            new_owners.extend([patch] * (j2 - j1))
+        for owner in sorted(others):
+            self.conflicts.append((planned.file_path, block, owner, patch))
+        planned.line_owners[block] = new_owners
+
+    def changed_files(self):
+        return [
+            planned
+            for planned in self.files.values()
+            if planned.text != planned.original
+        ]
+
+    def print_plan(self):
+        changed_files = self.changed_files()
+        print(
+            f"{BLUE}PLAN: {NC}{len(changed_files)} files, "
+            f"{sum(len(planned.edits) for planned in changed_files)} edits"
+        )
+        for planned in changed_files:
+            state = "new" if planned.original is None else "modified"
+            diffs = list(planned.block_diffs())
+            lines = [line for _, diff in diffs for line in diff[2:]]
+            added = sum(line.startswith("+") for line in lines)
+            removed = sum(line.startswith("-") for line in lines)
+            print(
+                f"{GREEN}{planned.file_path}{NC} ({state}, +{added} -{removed} lines)"
+            )
+            for patch, changed in planned.edits:
+                names = ", ".join(block or "<class body>" for block in changed)
+                print(f"    {patch}: {names}")
+            for _, diff in diffs:
+                for line in diff:
+                    print(line, end="" if line.endswith("\n") else "\n")
+
+    def commit(self, dry_run=False):
+        """Write every changed file once; with dry_run only print the plan."""
+        if dry_run:
+            self.print_plan()
+        for file_path, block, owner, patch in self.conflicts:
+            print(
+                f"{RED}CONFLICT: {NC}{block or '<class body>'} in {file_path}: "
+                f"patch {patch} rewrote lines of patch {owner}, keeping patch {patch}'s version"
+            )
+        if dry_run:
+            print(f"{YELLOW}INFO: {NC}Dry run, no files were written.")
+            return
+
+        changed_files = self.changed_files()
+        for planned in changed_files:
+            os.makedirs(os.path.dirname(planned.file_path) or ".", exist_ok=True)
+            with open(planned.file_path, "w") as file:
+                file.write(planned.text)
+        print(f"{GREEN}INFO: {NC}Wrote {len(changed_files)} patched files.")
+
+
+_patch_plan = PatchPlan()
+
+
+def read_smali_text(file_path):
+    """Return the current contents of a smali file, including pending edits.
+
+    Regex rules queued by regex_batch() are applied first.
+    """
+    flush_regex_batch()
+    return _patch_plan.read(file_path)
+
+
+def write_smali_text(file_path, file_content, patch=None):
+    """Queue new contents for a smali file; see commit_patch_plan().
+
+    Files restored from the patch cache are left alone.
+    """
+    if not is_cached(file_path):
+        _patch_plan.write(file_path, file_content, patch)
+
+
+@contextlib.contextmanager
+def planning_patch(patch):
+    """Attribute the edits made inside the block to the given patch number."""
+    previous = _patch_plan.current_patch
+    _patch_plan.current_patch = patch
+    try:
+        yield
+        save_smali_classes()
+    finally:
+        _patch_plan.current_patch = previous
+
+
+def file_digest(file_path):
+    with open(file_path, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+class PatchCache:
+    """Content-hash manifest of previous runs, see --cache.
+
+    The manifest maps every smali file (relative to the root directory) to
+    the hash of its decompiled source and of its patched output, for one
+    version of this script and one patch selection. Files whose source
+    hash is unchanged are skipped by the regex and method patches and get
+    their cached patched output copied over on commit.
+    """
+
+    def __init__(self, cache_dir, root_directory, selected_patches):
+        self.root_directory = root_directory
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        with open(os.path.abspath(__file__), "rb") as file:
+            script_hash = hashlib.sha1(file.read()).hexdigest()
+        self.version = f"{script_hash}:{','.join(selected_patches)}"
+
+        previous = {}
+        try:
+            with open(self.manifest_path, "r") as file:
+                manifest = json.load(file)
+            if manifest.get("version") == self.version:
+                previous = manifest["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        self.sources = {}  # file path -> source hash
+        self.cached = {}  # file path -> cached output hash, for unchanged files
+        for file_path in get_smali_index(root_directory).files:
+            digest = file_digest(file_path)
+            self.sources[file_path] = digest
+            entry = previous.get(os.path.relpath(file_path, root_directory))
+            if entry and entry[0] == digest and self._has_object(entry[1], digest):
+                self.cached[os.path.abspath(file_path)] = entry[1]
+        print(
+            f"{GREEN}INFO: {NC}{len(self.cached)} of {len(self.sources)} smali files unchanged since the cached run."
+        )
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def _has_object(self, digest, source_digest):
+        return digest == source_digest or os.path.exists(self._object_path(digest))
+
+    def is_cached(self, file_path):
+        return os.path.abspath(file_path) in self.cached
+
+    def commit(self, plan, dry_run=False):
+        """Restore cached outputs of unchanged files and record the new manifest."""
+        restored = [
+            file_path
+            for file_path, source in self.sources.items()
+            if self.cached.get(os.path.abspath(file_path), source) != source
+        ]
+        if dry_run:
+            print(
+                f"{YELLOW}INFO: {NC}{len(restored)} unchanged files would be restored from the cache."
+            )
+            return
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        files = {}
+        for file_path, source in self.sources.items():
+            output = self.cached.get(os.path.abspath(file_path))
+            if output is None:
+                output = source
+                if plan.is_planned(file_path):
+                    output = file_digest(file_path)
+                    if output != source and not os.path.exists(
+                        self._object_path(output)
+                    ):
+                        shutil.copyfile(file_path, self._object_path(output))
+            elif output != source:
+                shutil.copyfile(self._object_path(output), file_path)
+            files[os.path.relpath(file_path, self.root_directory)] = [source, output]
+
+        referenced = {output for source, output in files.values()}
+        for digest in os.listdir(self.objects_dir):
+            if digest not in referenced:
+                os.remove(self._object_path(digest))
+        with open(self.manifest_path, "w") as file:
+            json.dump({"version": self.version, "files": files}, file)
+        print(
+            f"{GREEN}INFO: {NC}Restored {len(restored)} unchanged files from the cache."
+        )
+
+
+_patch_cache = None
+
+
+def use_patch_cache(cache_dir, root_directory, selected_patches):
+    """Enable incremental patching against the manifest in cache_dir."""
+    global _patch_cache
+    _patch_cache = PatchCache(cache_dir, root_directory, selected_patches)
+
+
+def is_cached(file_path):
+    """Whether the patched output of file_path is restored from the patch cache."""
+    return _patch_cache is not None and _patch_cache.is_cached(file_path)
+
+
+def print_patched(file_path, message):
+    """Report a patch applied to file_path, unless its output comes from the cache.
+
+    Those files are only counted once, when PatchCache.commit() restores them.
+    """
+    if not is_cached(file_path):
+        print(f"{GREEN}INFO: {NC}{message}")
+
+
+def commit_patch_plan(dry_run=False):
+    """Write all pending edits (or print them with dry_run) and reset the run state."""
+    global _patch_plan, _patch_cache
+    save_smali_classes()
+    _patch_plan.commit(dry_run)
+    if _patch_cache is not None:
+        _patch_cache.commit(_patch_plan, dry_run)
+    _patch_plan = PatchPlan()
+    _patch_cache = None
+    _smali_classes.clear()
+    _smali_indexes.clear()
+
+
+class SmaliIndex:
+    """Index of a decompiled smali tree.
+
+    The tree is walked once; file contents are read (once) only when a
+    method lookup is first needed.
+    """
+
+    def __init__(self, root_directory):
+        self.root_directory = root_directory
+        self.files = []
+        self.by_name = {}
+        self._paths = set()
+        self.by_method = None
+        for dirpath, _, filenames in os.walk(root_directory):
+            for filename in filenames:
+                self.add(os.path.join(dirpath, filename))
+
+    def add(self, file_path):
+        """Register a (possibly newly created) file in the index."""
+        if file_path in self._paths:
+            return
+        self._paths.add(file_path)
+        filename = os.path.basename(file_path)
+        self.by_name.setdefault(filename, file_path)
+        if filename.endswith(".smali"):
+            self.files.append(file_path)
+            if self.by_method is not None:
+                self._scan_file(file_path)
+
+    def _scan_file(self, file_path):
+        for line in read_smali_text(file_path).splitlines():
+            line = line.strip()
+            if line.startswith(".method "):
+                self.by_method.setdefault(line[len(".method ") :], file_path)
+
+    def _scan(self):
+        if self.by_method is None:
+            self.by_method = {}
+            for file_path in self.files:
+                self._scan_file(file_path)
+
+    def find_file(self, target_file):
+        """Return the first file named target_file, or None."""
+        return self.by_name.get(target_file)
+
+    def find_method(self, method_name):
+        """Return the first smali file declaring method_name (e.g. 'private updateParams()V')."""
+        self._scan()
+        return self.by_method.get(method_name)
+
+
+_smali_indexes = {}
+
+
+def get_smali_index(root_directory):
+    """Return the smali index of root_directory, building it on first use."""
+    key = os.path.abspath(root_directory)
+    if key not in _smali_indexes:
+        _smali_indexes[key] = SmaliIndex(root_directory)
+    return _smali_indexes[key]
+
+
 def find_smali_file(root_directory, target_file):
-    """Recursively search for the target file within the root directory."""
-    for dirpath, _, filenames in os.walk(root_directory):
-        if target_file in filenames:
-            return os.path.join(dirpath, target_file)
-    return None
+    """Search for the target file within the root directory."""
+    return get_smali_index(root_directory).find_file(target_file)
 
 
 def find_smali_file_by_method(root_directory, method_name):
-    """Recursively search for the method in any smali file within the root directory."""
-    for dirpath, _, filenames in os.walk(root_directory):
-        for filename in filenames:
-            if filename.endswith(".smali"):
-                file_path = os.path.join(dirpath, filename)
-                with open(file_path, "r") as file:
-                    file_content = file.read()
-                    if method_name in file_content:
-                        return file_path
-    return None
+    """Search for the smali file declaring the method within the root directory."""
+    return get_smali_index(root_directory).find_method(method_name)
 
 
-def modify_method(file_path, method_name, new_method_code):
-    """Modify the method in the smali file."""
-    with open(file_path, "r") as file:
-        lines = file.readlines()
+class SmaliMethod:
+    """A `.method ... .end method` block of a smali class."""
 
-    in_method = False
-    new_lines = []
-    method_found = False
+    def __init__(self, signature, lines):
+        self.signature = signature
+        self.lines = lines
 
-    for line in lines:
-        if f".method {method_name}" in line:
-            in_method = True
-            method_found = True
-            new_lines.extend(new_method_code)
-            continue
 
-        if in_method:
-            if ".end method" in line:
-                in_method = False
-            continue
+class SmaliClass:
+    """A smali file parsed once into its method blocks.
 
-        new_lines.append(line)
+    Methods are looked up by signature (e.g. 'public isPremium()Z') and edited
+    in memory; save() serializes the file back into the patch plan.
+    """
 
-    if method_found:
-        with open(file_path, "w") as file:
-            file.writelines(new_lines)
-        print(f"{GREEN}INFO: {NC}Method {method_name} modified successfully.")
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.methods = {}
+        self.modified = False
+        # lines outside of methods and SmaliMethod objects, in file order
+        self._blocks = []
+
+        method = None
+        for line in read_smali_text(file_path).splitlines(keepends=True):
+            stripped = line.strip()
+            if method is not None:
+                method.lines.append(line)
+                if stripped == ".end method":
+                    self.methods.setdefault(method.signature, method)
+                    self._blocks.append(method)
+                    method = None
+            elif stripped.startswith(".method "):
+                method = SmaliMethod(stripped[len(".method ") :], [line])
+            else:
+                self._blocks.append(line)
+        if method is not None:
+            self._blocks.extend(method.lines)
+
+    def get_method(self, method_name):
+        """Return the method declared as `.method {method_name}`, or None."""
+        return self.methods.get(method_name)
+
+    def replace_method(self, method_name, new_method_code):
+        """Replace the method with new_method_code. Returns False if it isn't declared."""
+        return self.edit_method(method_name, lambda lines: list(new_method_code))
+
+    def edit_method(self, method_name, edit):
+        """Replace the lines of the method with edit(lines). Returns False if it isn't declared."""
+        method = self.methods.get(method_name)
+        if method is None:
+            return False
+        new_lines = edit(method.lines)
+        if new_lines != method.lines:
+            method.lines = new_lines
+            self.modified = True
+        return True
+
+    def copy_method(self, method_name, new_method_name):
+        """Append a copy of the method under a new name. Returns the copy, or None."""
+        method = self.methods.get(method_name)
+        if method is None:
+            return None
+        lines = [method.lines[0].replace(method_name, new_method_name)]
+        lines.extend(method.lines[1:])
+        copy = SmaliMethod(lines[0].strip()[len(".method ") :], lines)
+        self.methods.setdefault(copy.signature, copy)
+        self._blocks.append(copy)
+        self.modified = True
+        return copy
+
+    def serialize(self):
+        """Return the file contents."""
+        parts = []
+        for block in self._blocks:
+            if isinstance(block, SmaliMethod):
+                parts.extend(block.lines)
+            else:
+                parts.append(block)
+        return "".join(parts)
+
+    def save(self):
+        """Queue the file contents in the patch plan if it was modified."""
+        if self.modified:
+            write_smali_text(self.file_path, self.serialize())
+            self.modified = False
+
+
+class CachedSmaliClass:
+    """Stands in for the SmaliClass of a file the patch cache will restore.
+
+    Only its method signatures are read, so lookups (and the fallbacks that
+    depend on them) behave as in a full run. Edits are not applied: the
+    patched output is copied from the cache on commit.
+    """
+
+    modified = False
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.methods = set()
+        for line in read_smali_text(file_path).splitlines():
+            stripped = line.strip()
+            if stripped.startswith(".method "):
+                self.methods.add(stripped[len(".method ") :])
+
+    def get_method(self, method_name):
+        if method_name in self.methods:
+            return SmaliMethod(method_name, [])
+        return None
+
+    def replace_method(self, method_name, new_method_code):
+        return method_name in self.methods
+
+    def edit_method(self, method_name, edit):
+        return method_name in self.methods
+
+    def copy_method(self, method_name, new_method_name):
+        if method_name not in self.methods:
+            return None
+        self.methods.add(new_method_name)
+        return SmaliMethod(new_method_name, [])
+
+    def save(self):
+        pass
+
+
+_smali_classes = {}
+
+
+def load_smali_class(file_path):
+    """Return the parsed SmaliClass of file_path, shared by every patch of the run."""
+    key = os.path.abspath(file_path)
+    if key not in _smali_classes:
+        if is_cached(file_path):
+            _smali_classes[key] = CachedSmaliClass(file_path)
+        else:
+            _smali_classes[key] = SmaliClass(file_path)
+    return _smali_classes[key]
+
+
+def save_smali_classes():
+    """Queue every modified SmaliClass in the patch plan."""
+    for smali_class in _smali_classes.values():
+        smali_class.save()
+
+
+def forget_smali_class(file_path):
+    """Drop the parsed model of a file that was rewritten as text."""
+    _smali_classes.pop(os.path.abspath(file_path), None)
+
+
+def modify_method(file_path, method_name, new_method_code):
+    """Modify the method in the smali file."""
+    if load_smali_class(file_path).replace_method(method_name, new_method_code):
+        print_patched(file_path, f"Method {method_name} modified successfully.")
     else:
         raise NoMethodFoundError(
             f"{YELLOW}WARN: {NC}Method {method_name} not found in the file."
@@ -158,23 +682,12 @@ def modify_method(file_path, method_name, new_method_code):
 
 def modify_del_method(file_path, method_name, new_method_code):
     """Modify the method in the smali file."""
-    with open(file_path, "r") as file:
-        lines = file.readlines()
 
-    in_method = False
-    in_annotation = False
-    method_found = False
-    annotation_end_index = -1
-    new_lines = []
-
-    for i, line in enumerate(lines):
-        if f".method {method_name}" in line:
-            in_method = True
-            method_found = True
-            new_lines.append(line)
-            continue
-
-        if in_method:
+    def insert_after_annotations(lines):
+        new_lines = [lines[0]]
+        in_annotation = False
+        annotation_end_index = -1
+        for i, line in enumerate(lines[1:], 1):
             if ".annotation" in line:
                 in_annotation = True
             elif in_annotation and ".end annotation" in line:
@@ -190,16 +703,10 @@ def modify_del_method(file_path, method_name, new_method_code):
                 annotation_end_index = -1
 
             new_lines.append(line)
+        return new_lines
 
-            if ".end method" in line:
-                in_method = False
-        else:
-            new_lines.append(line)
-
-    if method_found:
-        with open(file_path, "w") as file:
-            file.writelines(new_lines)
-        print(f"{GREEN}INFO: {NC}Method {method_name} modified successfully.")
+    if load_smali_class(file_path).edit_method(method_name, insert_after_annotations):
+        print_patched(file_path, f"Method {method_name} modified successfully.")
     else:
         raise NoMethodFoundError(
             f"{YELLOW}WARN: {NC}Method {method_name} not found in the file."
@@ -208,70 +715,187 @@ def modify_del_method(file_path, method_name, new_method_code):
 
 def copy_method(file_path, original_method_name, new_method_name):
     """Copy the method in the smali file."""
-    with open(file_path, "r") as file:
-        lines = file.readlines()
+    if load_smali_class(file_path).copy_method(original_method_name, new_method_name):
+        print_patched(
+            file_path,
+            f"Method {original_method_name} copied to {new_method_name} successfully.",
+        )
+    else:
+        print(f"{YELLOW}WARN: {NC}Method {original_method_name} not found in the file.")
 
-    in_method = False
-    method_found = False
-    method_lines = []
 
-    for line in lines:
-        if f".method {original_method_name}" in line:
-            in_method = True
-            method_found = True
-            method_lines.append(line.replace(original_method_name, new_method_name))
-            continue
+class RegexRule:
+    """A regex search and replace patch for smali files.
 
-        if in_method:
-            method_lines.append(line)
-            if ".end method" in line:
-                in_method = False
+    A file is only searched if it contains every literal in `anchors`,
+    and, when `guard` is given, if that regex also matches somewhere in it.
+    """
 
-    if method_found:
-        with open(file_path, "a") as file:
-            file.writelines(method_lines)
-        print(
-            f"{GREEN}INFO: {NC}Method {original_method_name} copied to {new_method_name} successfully."
-        )
-    else:
-        print(f"{YELLOW}WARN: {NC}Method {original_method_name} not found in the file.")
+    def __init__(
+        self, search_pattern, replace_pattern, anchors=(), guard=None, name="regex"
+    ):
+        self.pattern = re.compile(search_pattern)
+        self.replace_pattern = replace_pattern
+        self.anchors = tuple(anchors)
+        self.guard = re.compile(guard) if guard else None
+        self.name = name
+        self.patch = None
 
+    def apply(self, file_content):
+        """Return file_content with the rule applied."""
+        if not all(anchor in file_content for anchor in self.anchors):
+            return file_content
+        if self.guard and not self.guard.search(file_content):
+            return file_content
+        return self.pattern.sub(self.replace_pattern, file_content)
 
-def apply_regex(root_directory, search_pattern, replace_pattern, file_path=None):
-    """Apply a regex search and replace patch across all smali files in the root directory or a specific file."""
-    pattern = re.compile(search_pattern)
 
-    if file_path:
-        with open(file_path, "r") as file:
-            file_content = file.read()
+_regex_batch = None
 
-        new_content = pattern.sub(replace_pattern, file_content)
 
-        if new_content != file_content:
-            with open(file_path, "w") as file:
-                file.write(new_content)
-            print(f"{GREEN}INFO: {NC}Applied regex patch to {file_path}")
-    else:
-        for dirpath, _, filenames in os.walk(root_directory):
-            for filename in filenames:
-                if filename.endswith(".smali"):
-                    file_path = os.path.join(dirpath, filename)
-                    with open(file_path, "r") as file:
-                        file_content = file.read()
+@contextlib.contextmanager
+def regex_batch():
+    """Queue apply_regex_rules() calls and apply them together.
+
+    Queued rules are flushed when the block ends, or as soon as a patch reads
+    a smali file, so they run at the same point of the patch order as without
+    batching. Consecutive regex patches (e.g. 10-13) still read and write every
+    smali file at most once for all their rules.
+    """
+    global _regex_batch
+    if _regex_batch is not None:
+        yield
+        return
+    _regex_batch = {}
+    try:
+        yield
+        flush_regex_batch()
+    finally:
+        _regex_batch = None
+
+
+def flush_regex_batch():
+    """Apply the queued regex rules now; see regex_batch()."""
+    global _regex_batch
+    if not _regex_batch:
+        return
+    batch = _regex_batch
+    _regex_batch = None  # apply, don't queue again
+    try:
+        for index, rules in batch.items():
+            print(
+                f"{YELLOW}START: {NC}Applying {len(rules)} batched regex rules to {index.root_directory}"
+            )
+            apply_regex_rules(index.root_directory, rules)
+    finally:
+        _regex_batch = {}
+
+
+def patch_text_with_rules(file_content, rules):
+    """Apply regex rules to smali source.
+
+    Returns the new source and the indexes of the rules that changed it.
+    """
+    applied = []
+    for i, rule in enumerate(rules):
+        patched = rule.apply(file_content)
+        if patched != file_content:
+            file_content = patched
+            applied.append(i)
+    return file_content, applied
+
+
+def _record_regex_result(file_path, new_content, applied, rules):
+    if not applied:
+        return
+    patches = dict.fromkeys(rules[i].patch for i in applied if rules[i].patch)
+    write_smali_text(file_path, new_content, ",".join(patches) or None)
+    forget_smali_class(file_path)
+    for name in dict.fromkeys(rules[i].name for i in applied):
+        print(f"{GREEN}INFO: {NC}Applied {name} patch to {file_path}")
+
+
+def apply_rules_to_file(file_path, rules):
+    """Apply regex rules to a single smali file and log what changed."""
+    if is_cached(file_path):
+        return
+    save_smali_classes()
+    new_content, applied = patch_text_with_rules(read_smali_text(file_path), rules)
+    _record_regex_result(file_path, new_content, applied, rules)
+
+
+_worker_rules = None
+
+
+def _init_regex_worker(rules):
+    global _worker_rules
+    _worker_rules = rules
+
+
+def _regex_worker(file_path):
+    with open(file_path, "r") as file:
+        new_content, applied = patch_text_with_rules(file.read(), _worker_rules)
+    return (new_content if applied else None), applied
+
+
+def apply_regex_rules(root_directory, rules):
+    """Apply regex rules across all smali files in the root directory in a single pass.
+
+    With JOBS > 1 the files without pending edits are sharded across a process
+    pool; log lines are still printed in file order.
+    """
+    index = get_smali_index(root_directory)
+    if _regex_batch is not None:
+        for rule in rules:
+            rule.patch = rule.patch or _patch_plan.current_patch
+        _regex_batch.setdefault(index, []).extend(rules)
+        return
+
+    save_smali_classes()
+    files = [file_path for file_path in index.files if not is_cached(file_path)]
+    if JOBS > 1 and len(files) > 1:
+        try:
+            executor = ProcessPoolExecutor(
+                max_workers=JOBS,
+                initializer=_init_regex_worker,
+                initargs=(rules,),
+            )
+        except (ImportError, NotImplementedError, OSError) as e:
+            print(f"{YELLOW}WARN: {NC}No regex workers ({e}), running inline.")
+        else:
+            with executor:
+                planned = [_patch_plan.is_planned(file_path) for file_path in files]
+                on_disk = [f for f, is_planned in zip(files, planned) if not is_planned]
+                chunksize = max(1, len(on_disk) // (JOBS * 16))
+                results = executor.map(_regex_worker, on_disk, chunksize=chunksize)
+                for file_path, is_planned in zip(files, planned):
+                    if is_planned:
+                        apply_rules_to_file(file_path, rules)
+                    else:
+                        _record_regex_result(file_path, *next(results), rules)
+            return
+
+    for file_path in files:
+        apply_rules_to_file(file_path, rules)
 
-                    new_content = pattern.sub(replace_pattern, file_content)
 
-                    if new_content != file_content:
-                        with open(file_path, "w") as file:
-                            file.write(new_content)
-                        print(f"{GREEN}INFO: {NC}Applied regex patch to {file_path}")
+def apply_regex(root_directory, search_pattern, replace_pattern, file_path=None):
+    """Apply a regex search and replace patch across all smali files in the root directory or a specific file."""
+    rules = [RegexRule(search_pattern, replace_pattern)]
+    if file_path:
+        apply_rules_to_file(file_path, rules)
+    else:
+        apply_regex_rules(root_directory, rules)
 
 
 def apply_isRestrictedMessage(root_directory):
     """Access Banned Channels [Related]"""
     search_pattern = r"(iget-boolean\s([v|p]\d+)\, ([v|p]\d+)\, Lorg/telegram/.*isRestrictedMessage:Z)"
     replace_pattern = r"\1\nconst \2, 0x0"
-    apply_regex(root_directory, search_pattern, replace_pattern)
+    apply_regex_rules(
+        root_directory,
+        [RegexRule(search_pattern, replace_pattern, ["isRestrictedMessage:Z"])],
+    )
 
 
 def apply_enableSavingMedia(root_directory):
@@ -280,7 +904,10 @@ def apply_enableSavingMedia(root_directory):
         r"(iget-boolean\s([v|p]\d+)\, ([v|p]\d+)\, Lorg/telegram/.*noforwards:Z)"
     )
     replace_pattern = r"\1\nconst \2, 0x0"
-    apply_regex(root_directory, search_pattern, replace_pattern)
+    apply_regex_rules(
+        root_directory,
+        [RegexRule(search_pattern, replace_pattern, ["noforwards:Z"])],
+    )
 
 
 def apply_premiumLocked(root_directory):
@@ -289,7 +916,10 @@ def apply_premiumLocked(root_directory):
         r"(iget-boolean\s([v|p]\d+)\, ([v|p]\d+)\, Lorg/telegram/.*premiumLocked:Z)"
     )
     replace_pattern = r"\1\nconst \2, 0x0"
-    apply_regex(root_directory, search_pattern, replace_pattern)
+    apply_regex_rules(
+        root_directory,
+        [RegexRule(search_pattern, replace_pattern, ["premiumLocked:Z"])],
+    )
 
 
 def apply_EnableScreenshots(root_directory):
@@ -298,28 +928,18 @@ def apply_EnableScreenshots(root_directory):
     secondary_search_pattern = r"const/16 (.*), 0x2000"
     replace_pattern = r"const/16 \1, 0x0"
 
-    for dirpath, _, filenames in os.walk(root_directory):
-        for filename in filenames:
-            if filename.endswith(".smali"):
-                file_path = os.path.join(dirpath, filename)
-                with open(file_path, "r") as file:
-                    file_content = file.read()
-
-                initial_matches = re.findall(initial_search_pattern, file_content)
-
-                if initial_matches:
-                    new_content = file_content
-                    for match in initial_matches:
-                        new_content = re.sub(
-                            secondary_search_pattern, replace_pattern, new_content
-                        )
-
-                    if new_content != file_content:
-                        with open(file_path, "w") as file:
-                            file.write(new_content)
-                        print(
-                            f"{GREEN}INFO: {NC}Applied windowFlags patch to {file_path}"
-                        )
+    apply_regex_rules(
+        root_directory,
+        [
+            RegexRule(
+                secondary_search_pattern,
+                replace_pattern,
+                ["Landroid/view/Window;->", "0x2000"],
+                guard=initial_search_pattern,
+                name="windowFlags",
+            )
+        ],
+    )
 
 
 def apply_EnableScreenshots2(root_directory):
@@ -330,23 +950,23 @@ def apply_EnableScreenshots2(root_directory):
     search_pattern2 = r"(iget-boolean\s([v|p]\d+)\, ([v|p]\d+)\, Lorg/telegram/ui/.*allowScreenshots:Z)"
     replace_pattern2 = r"\1\nconst \2, 0x1"
 
-    for dirpath, _, filenames in os.walk(root_directory):
-        for filename in filenames:
-            if filename.endswith(".smali"):
-                file_path = os.path.join(dirpath, filename)
-                with open(file_path, "r") as file:
-                    file_content = file.read()
-
-                new_content = re.sub(search_pattern1, replace_pattern1, file_content)
-
-                new_content = re.sub(search_pattern2, replace_pattern2, new_content)
-
-                if new_content != file_content:
-                    with open(file_path, "w") as file:
-                        file.write(new_content)
-                    print(
-                        f"{GREEN}INFO: {NC}Applied allowScreenCapture patch to {file_path}"
-                    )
+    apply_regex_rules(
+        root_directory,
+        [
+            RegexRule(
+                search_pattern1,
+                replace_pattern1,
+                ["SharedConfig;->allowScreenCapture:Z"],
+                name="allowScreenCapture",
+            ),
+            RegexRule(
+                search_pattern2,
+                replace_pattern2,
+                ["allowScreenshots:Z"],
+                name="allowScreenCapture",
+            ),
+        ],
+    )
 
 
 def apply_EnableScreenshots3(root_directory):
@@ -396,11 +1016,9 @@ def modify_markMessagesAsDeleted(file_path):
         smali_dir.append("classes2")
     smali_dir = "/".join(smali_dir)
     new_dir = os.path.join(smali_dir, "org", "telegram", "abhi")
-    if not os.path.exists(new_dir):
-        os.makedirs(new_dir, exist_ok=True)
     hook_file = os.path.join(new_dir, "Hook.smali")
-    with open(hook_file, "w") as file:
-        file.write(HOOK_SMALI)
+    write_smali_text(hook_file, HOOK_SMALI)
+    get_smali_index(root_dir).add(hook_file)
 
     search_pattern = r"sget\s([v|p]\d),\sLorg/telegram/messenger/R\$string;->ShowAds:I\n+\s+(invoke-static\s{\1},\sLorg/telegram/messenger/LocaleController;->getString\(I\)Ljava/lang/String;\n+\s+move-result-object\s\1|goto\s:goto_\d+)((\n.*)*?)invoke-virtual\s({.*}),\sLorg/telegram/ui/Cells/TextCell;->setTextAndCheck\(Ljava/lang/CharSequence;ZZ\)V"
 
@@ -412,11 +1030,18 @@ def modify_markMessagesAsDeleted(file_path):
     replace_pattern2 = r'const-string \1, "After enabling or disabling the feature, ensure you revisit this page for the changes to take effect.\\nMod by Abhi"'
     replace_pattern3 = r'const-string \1, "Anti-Delete Messages"\n    invoke-virtual {v1, \1}, Lorg/telegram/ui/Cells/HeaderCell;->setText(Ljava/lang/CharSequence;)V\n    return-void'
 
-    search_patterns = [search_pattern, search_pattern2, search_pattern3]
-    replace_patterns = [replace_pattern, replace_pattern2, replace_pattern3]
-
-    for i, s_p in enumerate(search_patterns):
-        apply_regex(root_dir, s_p, replace_patterns[i])
+    apply_regex_rules(
+        root_dir,
+        [
+            RegexRule(
+                search_pattern,
+                replace_pattern,
+                ["R$string;->ShowAds:I", "TextCell;->setTextAndCheck("],
+            ),
+            RegexRule(search_pattern2, replace_pattern2, ["R$string;->ShowAdsInfo:I"]),
+            RegexRule(search_pattern3, replace_pattern3, ["R$string;->ShowAdsTitle:I"]),
+        ],
+    )
 
     automate_modification(root_dir, "TextCell.smali", create_delcopy_method)
 
@@ -459,13 +1084,6 @@ def modify_markMessagesAsDeleted(file_path):
 def modify_del_oncreate_method(file_path):
     method_name = "protected onCreate(Landroid/os/Bundle;)V"
     method_name2 = "public onCreate(Landroid/os/Bundle;)V"  # For plus
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-
-    new_lines = []
-    in_method = False
-    method_found = False
-    cond_label_pattern = re.compile(r":cond_\d")
     new_codes = [
         "    sget-object v0, Lorg/telegram/messenger/ApplicationLoader;->applicationContext:Landroid/content/Context;\n",
         '    const-string v1, "mainconfig"\n',
@@ -479,6 +1097,14 @@ def modify_del_oncreate_method(file_path):
         "    sput-boolean v0, Lorg/telegram/abhi/Hook;->candelMessages:Z\n",
     ]
 
+    save_smali_classes()
+    lines = read_smali_text(file_path).splitlines(keepends=True)
+
+    new_lines = []
+    in_method = False
+    method_found = False
+    cond_label_pattern = re.compile(r":cond_\d")
+
     for line in lines:
         if f".method {method_name}" or f".method {method_name2}" in line:
             in_method = True
@@ -505,9 +1131,9 @@ def modify_del_oncreate_method(file_path):
         new_lines.append(line)
 
     if method_found:
-        with open(file_path, "w") as file:
-            file.writelines(new_lines)
-        print(f"{GREEN}INFO: {NC}Method {method_name} modified successfully.")
+        forget_smali_class(file_path)
+        write_smali_text(file_path, "".join(new_lines))
+        print_patched(file_path, f"Method {method_name} modified successfully.")
     else:
         print(f"{YELLOW}WARN: {NC}Method {method_name} not found in the file.")
         sys.exit(1)
@@ -520,13 +1146,6 @@ def create_delcopy_method(file_path):
         "public setTextAndCheck(Ljava/lang/CharSequence;ZZ)V",
         method_name,
     )
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-
-    new_lines = []
-    in_method = False
-    method_found = False
-    cond_label_pattern = re.compile(r":cond_\d")
     new_codes = [
         "    invoke-virtual {p0}, Landroid/view/View;->getContext()Landroid/content/Context;\n",
         "    move-result-object v1\n",
@@ -546,34 +1165,17 @@ def create_delcopy_method(file_path):
         "    return-void\n",
     ]
 
-    for line in lines:
-        if f".method {method_name}" in line:
-            in_method = True
-            method_found = True
-            new_lines.append(line)
-            continue
-
-        if in_method:
-            if cond_label_pattern.search(line):
-                new_lines.append(line)
-                continue
-
+    def show_toast_and_hook(lines):
+        new_lines = []
+        for line in lines:
             if "return-void" in line:
                 new_lines.extend(new_codes)
             else:
                 new_lines.append(line)
+        return new_lines
 
-            if ".end method" in line:
-                in_method = False
-
-            continue
-
-        new_lines.append(line)
-
-    if method_found:
-        with open(file_path, "w") as file:
-            file.writelines(new_lines)
-        print(f"{GREEN}INFO: {NC}Method {method_name} modified successfully.")
+    if load_smali_class(file_path).edit_method(method_name, show_toast_and_hook):
+        print_patched(file_path, f"Method {method_name} modified successfully.")
     else:
         print(f"{YELLOW}WARN: {NC}Method {method_name} not found in the file.")
         sys.exit(1)
@@ -691,42 +1293,15 @@ def modify_markStories_method(file_path):
 
 def modify_isPremiumFeatureAvailable_method(file_path, method_name):
     """Modify isPremiumFeatureAvailable method to change 'const/4 v1, 0x0' to 'const/4 v1, 0x1'."""
-    with open(file_path, "r") as file:
-        lines = file.readlines()
 
-    new_lines = []
-    in_method = False
-    method_found = False
-    cond_label_pattern = re.compile(r":cond_\d")
-
-    for line in lines:
-        if f".method {method_name}" in line:
-            in_method = True
-            method_found = True
-            new_lines.append(line)
-            continue
-
-        if in_method:
-            if cond_label_pattern.search(line):
-                new_lines.append(line)
-                continue
-
-            if "const/4 v1, 0x0" in line:
-                new_lines.append("    const/4 v1, 0x1\n")
-            else:
-                new_lines.append(line)
-
-            if ".end method" in line:
-                in_method = False
-
-            continue
-
-        new_lines.append(line)
+    def enable_feature(lines):
+        return [
+            "    const/4 v1, 0x1\n" if "const/4 v1, 0x0" in line else line
+            for line in lines
+        ]
 
-    if method_found:
-        with open(file_path, "w") as file:
-            file.writelines(new_lines)
-        print(f"{GREEN}INFO: {NC}Method {method_name} modified successfully.")
+    if load_smali_class(file_path).edit_method(method_name, enable_feature):
+        print_patched(file_path, f"Method {method_name} modified successfully.")
     else:
         print(f"{YELLOW}WARN: {NC}Method {method_name} not found in the file.")
 
@@ -735,17 +1310,6 @@ def modify_secret_media_methods(file_path):
     """Modify given methods in MessageObject.smali for Secret Media Enabler.
     - This allows users to view secret media without worrying about their destruction or timeout.
     """
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-
-    new_lines = []
-    in_method = False
-    method_found = {
-        "public getSecretTimeLeft()I": False,
-        "public isSecretMedia()Z": False,
-        "public static isSecretPhotoOrVideo(Lorg/telegram/tgnet/TLRPC$Message;)Z": False,
-        "public static isSecretMedia(Lorg/telegram/tgnet/TLRPC$Message;)Z": False,
-    }
     method_codes = {
         "public isSecretMedia()Z": [
             ".method public isSecretMedia()Z\n",
@@ -776,86 +1340,45 @@ def modify_secret_media_methods(file_path):
         ],
     }
 
-    for line in lines:
-        if any(method_name in line for method_name in method_found.keys()):
-            in_method = True
-            method_name = next(
-                method_name
-                for method_name in method_found.keys()
-                if method_name in line
-            )
-            method_found[method_name] = True
-            if method_name == "public getSecretTimeLeft()I":
-                new_lines.append(line)
-                continue
+    def never_expire(lines):
+        new_lines = []
+        for line in lines:
+            if "const/4 v1, 0x0" in line:
+                new_lines.append("    const/4 v1, 0x1\n")
+                print(
+                    f"{GREEN}INFO: {NC}Modified const/4 v1, 0x0 to const/4 v1, 0x1 in getSecretTimeLeft method."
+                )
             else:
-                new_lines.extend(method_codes[method_name])
-                continue
-
-        if in_method:
-            if method_name == "public getSecretTimeLeft()I":
-                if "const/4 v1, 0x0" in line:
-                    new_lines.append("    const/4 v1, 0x1\n")
-                    print(
-                        f"{GREEN}INFO: {NC}Modified const/4 v1, 0x0 to const/4 v1, 0x1 in getSecretTimeLeft method."
-                    )
-                else:
-                    new_lines.append(line)
-
-            if ".end method" in line:
-                in_method = False
-            continue
-
-        new_lines.append(line)
-
-    if all(method_found.values()):
-        with open(file_path, "w") as file:
-            file.writelines(new_lines)
-        print(f"{GREEN}INFO: {NC}Secret Media methods modified successfully.")
+                new_lines.append(line)
+        return new_lines
+
+    smali_class = load_smali_class(file_path)
+    method_names = ["public getSecretTimeLeft()I", *method_codes]
+    if all(smali_class.get_method(method_name) for method_name in method_names):
+        smali_class.edit_method("public getSecretTimeLeft()I", never_expire)
+        for method_name, new_method_code in method_codes.items():
+            smali_class.replace_method(method_name, new_method_code)
+        print_patched(file_path, "Secret Media methods modified successfully.")
     else:
         print(f"{YELLOW}WARN: {NC}Some Secret Media methods not found in the file.")
 
 
 def modify_updateParams_method(file_path, method_name):
     """Modify updateParams method for faster downloads"""
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-
-    new_lines = []
-    in_method = False
-    method_found = False
-    cond_label_pattern = re.compile(r":cond_\d")
-
-    for line in lines:
-        if f".method {method_name}" in line:
-            in_method = True
-            method_found = True
-            new_lines.append(line)
-            continue
-
-        if in_method:
-            if cond_label_pattern.search(line):
-                new_lines.append(line)
-                continue
 
+    def raise_limits(lines):
+        new_lines = []
+        for line in lines:
             if "const/high16 v0, 0x20000" in line:
                 new_lines.append("    const/high16 v0, 0x80000\n")
             elif "const/4 v0, 0x4" in line:
                 new_lines.append("    const/16 v0, 0x8\n")
             else:
                 new_lines.append(line)
+        return new_lines
 
-            if ".end method" in line:
-                in_method = False
-
-            continue
-
-        new_lines.append(line)
-
-    if method_found:
-        with open(file_path, "w") as file:
-            file.writelines(new_lines)
-        print(f"{GREEN}INFO: {NC}Method {method_name} modified successfully.")
+    if load_smali_class(file_path).edit_method(method_name, raise_limits):
+        print_patched(file_path, f"Method {method_name} modified successfully.")
     else:
         print(f"{YELLOW}WARN: {NC}Method {method_name} not found in the file.")
 
@@ -1068,13 +1591,19 @@ def automate_method_modification(root_directory, method_name, modification_funct
 
 def apply_patches(patches, exclude=None):
     """Apply all patches except the ones specified in the exclude list."""
-    for key, value in patches.items():
-        if key not in exclude:
-            value[1]()
+    with regex_batch():
+        for key, value in patches.items():
+            if key not in exclude:
+                with planning_patch(key):
+                    value[1]()
+
 
+def main(selected_patch=None, root_directory=None, dry_run=False, cache_dir=None):
+    """Main function to handle user input and apply patches.
 
-def main(selected_patch=None, root_directory=None):
-    """Main function to handle user input and apply patches."""
+    With dry_run the patch plan is printed instead of written to disk. With
+    cache_dir, files unchanged since the last cached run are not re-patched.
+    """
 
     if root_directory == "Telegram":
         root_directory = (
@@ -1224,14 +1753,20 @@ def main(selected_patch=None, root_directory=None):
     else:
         selected_patches = [selected_patch]
 
-    for patch in selected_patches:
-        if patch in patches:
-            print(
-                f"{YELLOW}START: {NC}Applying patch {patch}: {BLUE}{patches[patch][0]}{NC}"
-            )
-            patches[patch][1]()
-        else:
-            print(f"{RED}ERROR: {NC}Invalid patch number: {patch}")
+    if cache_dir:
+        use_patch_cache(cache_dir, root_directory, selected_patches)
+
+    with regex_batch():
+        for patch in selected_patches:
+            if patch in patches:
+                print(
+                    f"{YELLOW}START: {NC}Applying patch {patch}: {BLUE}{patches[patch][0]}{NC}"
+                )
+                with planning_patch(patch):
+                    patches[patch][1]()
+            else:
+                print(f"{RED}ERROR: {NC}Invalid patch number: {patch}")
+    commit_patch_plan(dry_run)
 
 
 if __name__ == "__main__":
@@ -1254,16 +1789,45 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dir", help="Specify the directory", required=False, default="Telegram"
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of worker processes for regex patches",
+        type=int,
+        required=False,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        help="Print a diff of the planned edits without writing any file",
+        required=False,
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--cache",
+        help="Directory of the content-hash cache used to skip unchanged files",
+        required=False,
+        default=None,
+    )
 
     args = parser.parse_args()
+    JOBS = max(1, args.jobs)
 
     try:
         if args.normal:
-            main(selected_patch="0", root_directory=args.dir)
+            selected_patch = "0"
         elif args.anti:
-            main(selected_patch="00", root_directory=args.dir)
+            selected_patch = "00"
         else:
-            main(root_directory=args.dir)
+            selected_patch = None
+        main(
+            selected_patch=selected_patch,
+            root_directory=args.dir,
+            dry_run=args.dry_run,
+            cache_dir=args.cache,
+        )
     except KeyboardInterrupt:
         print(f"\n{RED}ERROR: {NC}Script interrupted by user.")
         sys.exit(1)